@@ -1,36 +1,36 @@
+import argparse
 import json
-import sys
 
 from lib.config import parse
 from lib.db import UDB
+from lib.profiling import add_profile_argument, profile_run
 from lib.utils import MessageType
 
 
 def main():
-    with open('config.toml') as cf:
-        config = parse(cf)
-    if len(sys.argv) != 3:
-        raise ValueError('Usage: "author.py import <filename>" or author.py export <filename>')
-    _, action, fp = sys.argv
+    parser = argparse.ArgumentParser(description='Import or export the monitor lists')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('file')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    fp = args.file
     if not fp.endswith(".backup.json"):
         raise ValueError("extname of target file should be '.backup.json'")
-    with UDB(config.redis) as db:
-        if action == 'import':
+    with open('config.toml') as cf:
+        config = parse(cf)
+    with profile_run('authors', args.profile), UDB(config.redis) as db:
+        if args.action == 'import':
             with open(fp) as f:
                 data = json.load(f)
             for k, v in data.items():
-                t = MessageType(k)
-                for m in v:
-                    db.monitor_add(t, m)
-        elif action == 'export':
+                db.monitor_add_many(MessageType(k), v)
+        else:
             data = {
                 t.value: db.monitor_list(t)
                 for t in MessageType
             }
             with open(fp, 'w') as f:
                 json.dump(data, f)
-        else:
-            raise ValueError("Unknown action: " + action)
 
 
 if __name__ == '__main__':
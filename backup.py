@@ -0,0 +1,226 @@
+import argparse
+import base64
+import gzip
+import json
+import sys
+import time
+from typing import Iterable, Dict, Any, IO, List
+
+import redis
+
+from lib.config import parse
+from lib.db import UDB
+from lib.profiling import add_profile_argument, profile_run
+
+KEY_PATTERN = 'stbot.*'
+SCAN_COUNT = 1000
+CHUNK_SIZE = 1000
+PROGRESS_EVERY = 10000
+
+# Keys and values are arbitrary bytes; latin-1 maps them one to one onto JSON strings.
+_CODEC = 'latin-1'
+
+
+def _s(b: bytes) -> str:
+    return b.decode(_CODEC)
+
+
+def _b(s: str) -> bytes:
+    return s.encode(_CODEC)
+
+
+class Progress:
+    def __init__(self, action: str):
+        self.action = action
+        self.keys = 0
+        self.records = 0
+        self.start = time.time()
+
+    def add(self, keys: int, records: int):
+        before = self.keys // PROGRESS_EVERY
+        self.keys += keys
+        self.records += records
+        if self.keys // PROGRESS_EVERY != before:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print(f"{self.action}: {self.keys} keys, {self.records} records, "
+              f"{self.keys / elapsed:.0f} keys/s", file=sys.stderr)
+
+
+def _first_read(p: redis.client.Pipeline, key: bytes, type_: str):
+    if type_ == 'string':
+        p.get(key)
+    elif type_ == 'list':
+        p.lrange(key, 0, CHUNK_SIZE - 1)
+    elif type_ == 'hash':
+        p.hscan(key, 0, count=CHUNK_SIZE)
+    elif type_ == 'set':
+        p.sscan(key, 0, count=CHUNK_SIZE)
+    elif type_ == 'zset':
+        p.zscan(key, 0, count=CHUNK_SIZE)
+    elif type_ == 'stream':
+        p.xrange(key, count=CHUNK_SIZE)
+    else:
+        p.dump(key)
+
+
+def _encode_chunk(type_: str, chunk) -> Any:
+    if type_ == 'string':
+        return _s(chunk)
+    elif type_ in ('list', 'set'):
+        return [_s(v) for v in chunk]
+    elif type_ == 'hash':
+        return {_s(k): _s(v) for k, v in chunk.items()}
+    elif type_ == 'zset':
+        return [[_s(m), s] for m, s in chunk]
+    elif type_ == 'stream':
+        return [[_s(eid), {_s(k): _s(v) for k, v in fields.items()}] for eid, fields in chunk]
+    else:
+        return base64.b64encode(chunk).decode('ascii')
+
+
+def _iter_chunks(conn: redis.Redis, key: bytes, type_: str, first) -> Iterable[Any]:
+    # Yields the first chunk read in the batch pipeline, then pages through whatever is left.
+    if type_ in ('hash', 'set', 'zset'):
+        cursor, chunk = first
+        scan = {'hash': conn.hscan, 'set': conn.sscan, 'zset': conn.zscan}[type_]
+        while True:
+            if chunk:
+                yield chunk
+            if cursor == 0:
+                return
+            cursor, chunk = scan(key, cursor, count=CHUNK_SIZE)
+    elif type_ == 'list':
+        start = 0
+        chunk = first
+        while chunk:
+            yield chunk
+            if len(chunk) < CHUNK_SIZE:
+                return
+            start += CHUNK_SIZE
+            chunk = conn.lrange(key, start, start + CHUNK_SIZE - 1)
+    elif type_ == 'stream':
+        chunk = first
+        while chunk:
+            yield chunk
+            if len(chunk) < CHUNK_SIZE:
+                return
+            chunk = conn.xrange(key, min=b'(' + chunk[-1][0], count=CHUNK_SIZE)
+    elif first is not None:
+        yield first
+
+
+def _scan_batches(conn: redis.Redis) -> Iterable[List[bytes]]:
+    batch = []
+    for k in conn.scan_iter(match=KEY_PATTERN, count=SCAN_COUNT):
+        batch.append(k)
+        if len(batch) >= SCAN_COUNT:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def backup(conn: redis.Redis, out: IO[str]):
+    progress = Progress('backup')
+    for keys in _scan_batches(conn):
+        with conn.pipeline(transaction=False) as p:
+            for k in keys:
+                p.type(k)
+                p.pttl(k)
+            meta = p.execute()
+        types = [t.decode('ascii') if isinstance(t, bytes) else t for t in meta[0::2]]
+        ttls = meta[1::2]
+        with conn.pipeline(transaction=False) as p:
+            for k, t in zip(keys, types):
+                _first_read(p, k, t)
+            firsts = p.execute()
+        records = 0
+        for k, t, ttl, first in zip(keys, types, ttls, firsts):
+            if t == 'none':
+                continue
+            record_type = t if t in ('string', 'list', 'hash', 'set', 'zset', 'stream') else 'dump'
+            for i, chunk in enumerate(_iter_chunks(conn, k, t, first)):
+                record: Dict[str, Any] = {'k': _s(k), 't': record_type, 'v': _encode_chunk(t, chunk)}
+                if i == 0 and ttl > 0:
+                    record['x'] = ttl
+                out.write(json.dumps(record))
+                out.write('\n')
+                records += 1
+        progress.add(len(keys), records)
+    progress.report()
+
+
+def _write_record(p: redis.client.Pipeline, key: bytes, type_: str, value, ttl: int):
+    if type_ == 'string':
+        p.set(key, _b(value))
+    elif type_ == 'list':
+        p.rpush(key, *[_b(v) for v in value])
+    elif type_ == 'hash':
+        p.hset(key, mapping={_b(k): _b(v) for k, v in value.items()})
+    elif type_ == 'set':
+        p.sadd(key, *[_b(v) for v in value])
+    elif type_ == 'zset':
+        p.zadd(key, {_b(m): s for m, s in value})
+    elif type_ == 'stream':
+        for eid, fields in value:
+            p.xadd(key, {_b(k): _b(v) for k, v in fields.items()}, id=_b(eid))
+    elif type_ == 'dump':
+        p.restore(key, 0, base64.b64decode(value), replace=True)
+    else:
+        raise ValueError(f"Unknown record type: {type_}")
+    if ttl > 0:
+        p.pexpire(key, ttl)
+
+
+def restore(conn: redis.Redis, src: IO[str], batch_size: int, replace: bool):
+    if not replace and next(conn.scan_iter(match=KEY_PATTERN, count=SCAN_COUNT), None) is not None:
+        raise ValueError("Target database already has stbot.* keys, use --replace to overwrite them")
+    progress = Progress('restore')
+    prev_key = None
+    keys = records = 0
+    p = conn.pipeline(transaction=False)
+    for line in src:
+        record = json.loads(line)
+        key = _b(record['k'])
+        if key != prev_key:
+            # All chunks of a key are consecutive, so the key is replaced on its first chunk.
+            p.delete(key)
+            prev_key = key
+            keys += 1
+        _write_record(p, key, record['t'], record['v'], record.get('x', -1))
+        records += 1
+        if records % batch_size == 0:
+            p.execute()
+            progress.add(keys, records)
+            keys = records = 0
+    p.execute()
+    progress.add(keys, records)
+    progress.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream every stbot.* key to or from gzipped NDJSON')
+    parser.add_argument('action', choices=['backup', 'restore'])
+    parser.add_argument('file')
+    parser.add_argument('--batch', type=int, default=1000, help='records per restore pipeline')
+    parser.add_argument('--replace', action='store_true', help='restore into a database that has stbot.* keys')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if not args.file.endswith('.ndjson.gz'):
+        raise ValueError("extname of target file should be '.ndjson.gz'")
+    with open('config.toml') as cf:
+        config = parse(cf)
+    with profile_run(args.action, args.profile), UDB(config.redis) as db:
+        if args.action == 'backup':
+            with gzip.open(args.file, 'wt', encoding='utf-8') as f:
+                backup(db.conn, f)
+        else:
+            with gzip.open(args.file, 'rt', encoding='utf-8') as f:
+                restore(db.conn, f, args.batch, args.replace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import os
+import time
+
+from PIL import Image
+
+from lib.cache import cache_path
+from lib.config import parse
+from lib.db import UDB
+from lib.db.names import DATA_PREFIX, get_uid_from_key
+from lib.db.utils import ENCODING
+from lib.image_index import ImageIndex, update_index
+from lib.phash import image_hashes
+from lib.profiling import add_profile_argument, profile_run
+
+CHUNK_SIZE = 500
+
+
+def backfill(db: UDB) -> int:
+    # Only images still in the local cache can be hashed; anything already moved to WebDAV is skipped.
+    known = {u.decode('utf-8') for u in ImageIndex().records['u']} | {uid for _, uid in db.image_hash_range(0)}
+    n = 0
+    chunk = []
+    for k in db.conn.scan_iter(match=f"{DATA_PREFIX}:*", count=CHUNK_SIZE):
+        uid = get_uid_from_key(k.decode(ENCODING))
+        if uid not in known:
+            chunk.append(uid)
+        if len(chunk) >= CHUNK_SIZE:
+            n += _backfill_chunk(db, chunk)
+            chunk = []
+    if chunk:
+        n += _backfill_chunk(db, chunk)
+    return n
+
+
+def _backfill_chunk(db: UDB, uids) -> int:
+    n = 0
+    for msg in db.get_data_many(uids):
+        if msg is None:
+            continue
+        hashes = []
+        for u in msg.media_list:
+            id_ = db.get_file(u)
+            if id_ is not None and os.path.exists(cache_path(id_)):
+                with Image.open(cache_path(id_)) as img:
+                    hashes.extend(image_hashes(img))
+                n += 1
+        db.image_hash_add(msg.uid, hashes)
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Append new image hashes to the on-disk reverse image index')
+    parser.add_argument('--backfill', action='store_true', help='hash cached images downloaded before hashing existed')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    with profile_run('build_image_index', args.profile), UDB(config.redis) as db:
+        start = time.time()
+        if args.backfill:
+            print(f"Hashed {backfill(db)} cached images")
+        n = update_index(db)
+        print(f"Indexed {n} new hashes, {db.image_hash_count()} total in {time.time() - start:.0f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,16 @@
-import os
+import argparse
 import traceback
 from pathlib import Path
 from typing import Dict, Set
 
 from webdav3.client import Client
 
-from lib.cache import cache_path
+from lib.cache import cache_path, remove_cache
 from lib.config import parse, WebDavConfig
 from lib.db import UDB
-from lib.utils import UMessage, MessageType
+from lib.profiling import add_profile_argument, profile_run, timed
+from lib.utils import UMessage, MessageType, MessageStatus
+from lib.worker import Deadline, add_deadline_argument, poll_within, run_stage
 
 
 def _target_dir(config: WebDavConfig, msg: UMessage) -> str:
@@ -26,43 +28,63 @@ def get_client(config: WebDavConfig) -> Client:
     return client
 
 
-def update_files(db: UDB, client: Client, root_dir: Path, retry_limit: int):
+def list_remote_authors(client: Client, root_dir: Path) -> Dict[MessageType, Set[str]]:
     services_dir = set([t.value for t in MessageType])
     for s in set(services_dir) - set(client.list(str(root_dir))):
         client.mkdir(str(root_dir / s))
-    authors: Dict[MessageType, Set[str]] = {
+    return {
         t: set(client.list(str(root_dir / t.value)))
         for t in MessageType
     }
-    for msg in db.success_iter_poll():
+
+
+def update_files(db: UDB, client: Client, root_dir: Path, authors: Dict[MessageType, Set[str]],
+                 retry_limit: int, deadline: Deadline) -> int:
+    n = 0
+    for msg in poll_within(db, MessageStatus.Success, None, deadline):
+        n += 1
         try:
             if msg.monitor not in authors[msg.type]:
-                client.mkdir(str(root_dir / msg.type.value / msg.monitor))
+                with timed('webdav'):
+                    client.mkdir(str(root_dir / msg.type.value / msg.monitor))
                 authors[msg.type].add(msg.monitor)
-            local_files = [
-                cache_path(db.get_file(u))
+            cache_ids = [
+                db.get_file(u)
                 for u in msg.media_list
             ]
-            for i, local_path in enumerate(local_files):
+            for i, id_ in enumerate(cache_ids):
+                local_path = cache_path(id_)
                 remote_path = str(root_dir / msg.type.value / msg.monitor / f"{msg.id}_{i}.jpg")
                 print(local_path, ">>>", remote_path)
-                client.upload(remote_path, local_path)
-            for f in local_files:
-                os.remove(f)
+                with timed('webdav'):
+                    client.upload(remote_path, local_path)
+            for id_ in cache_ids:
+                remove_cache(id_)
         except Exception as err:
             traceback.print_exc()
-            db.retry_or_fail(msg.uid, db.clean_retry, retry_limit)
+            db.retry_or_fail(msg.uid, db.clean_retry, retry_limit, err)
         else:
             db.clean(msg.uid)
+    return n
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--follow', action='store_true', help='keep running and wake up on new posted messages')
+    add_deadline_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     with open("config.toml") as cf:
         config = parse(cf)
 
     client = get_client(config.webdav)
-    with UDB(config.redis) as db:
-        update_files(db, client, Path(config.webdav.root_dir), config.crawler.retry_limit)
+    root_dir = Path(config.webdav.root_dir)
+    with profile_run('clean_to_webdav', args.profile), UDB(config.redis, crawler=config.crawler) as db:
+        with timed('webdav'):
+            authors = list_remote_authors(client, root_dir)
+        deadline = Deadline(db, MessageStatus.Success, args.deadline)
+        step = lambda: update_files(db, client, root_dir, authors, config.crawler.retry_limit, deadline)
+        run_stage(db, MessageStatus.Success, step, args.follow, deadline=deadline)
 
 
 if __name__ == '__main__':
@@ -1,38 +1,78 @@
+import argparse
 import time
 import traceback
 from io import BytesIO
+from typing import Tuple, Optional, List
 
 import requests
+from PIL import Image
 
 from lib.cache import add_cache
-from lib.config import parse
+from lib.config import parse, UConfig
 from lib.db import UDB
+from lib.phash import image_hashes
+from lib.profiling import add_profile_argument, profile_run, timed
+from lib.utils import MessageStatus
+from lib.worker import Deadline, add_deadline_argument, poll_within, run_stage
 
+PIXIV_REFERER = 'https://app-api.pixiv.net/'
 
-def save_image(url: str) -> str:
-    res = requests.get(url)
+
+def save_image(url: str) -> Tuple[str, List[bytes]]:
+    # pximg.net refuses image requests that do not come from the Pixiv app.
+    headers = {'Referer': PIXIV_REFERER} if 'pximg.net' in url else None
+    with timed('http'):
+        res = requests.get(url, headers=headers)
     bio = BytesIO(res.content)
-    id_ = add_cache(bio)
-    return id_
+    with timed('pillow'):
+        id_ = add_cache(bio)
+        bio.seek(0)
+        return id_, image_hashes(Image.open(bio))
+
+
+def download_images(db: UDB, config: UConfig, limit: Optional[int], deadline: Deadline) -> int:
+    n = 0
+    for msg in poll_within(db, MessageStatus.Downloading, limit, deadline):
+        n += 1
+        try:
+            hashes = []
+            for u in msg.media_list:
+                fp, hs = save_image(u)
+                print(u, '=>', fp)
+                time.sleep(config.crawler.cool_down_time)
+                db.add_file(u, fp)
+                hashes.extend(hs)
+            db.image_hash_add(msg.uid, hashes)
+        except Exception as err:
+            db.retry_or_fail(msg.uid, db.download_retry, config.crawler.retry_limit, err)
+            traceback.print_exc()
+        else:
+            db.post_add(msg.uid)
+    return n
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--follow', action='store_true', help='keep running and wake up on new downloads')
+    add_deadline_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     with open('config.toml') as cf:
         config = parse(cf)
 
-    with UDB(config.redis) as db:
-        for msg in db.download_iter_poll(config.crawler.download_limit):
-            try:
-                for u in msg.media_list:
-                    fp = save_image(u)
-                    print(u, '=>', fp)
-                    time.sleep(config.crawler.cool_down_time)
-                    db.add_file(u, fp)
-            except Exception as err:
-                db.retry_or_fail(msg.uid, db.download_retry, config.crawler.retry_limit)
-                traceback.print_exc()
-            else:
-                db.post_add(msg.uid)
+    with profile_run('image_crawler', args.profile), UDB(config.redis, crawler=config.crawler) as db:
+        deadline = Deadline(db, MessageStatus.Downloading, args.deadline)
+        if args.follow:
+            # download_limit bounds how many downloaded messages may wait for the poster
+            step = lambda: download_images(db, config, max(config.crawler.download_limit - db.post_count(), 0),
+                                           deadline)
+        elif args.deadline is not None:
+            # The deadline sizes a one-off run instead of download_limit.
+            step = lambda: download_images(db, config, None, deadline)
+        else:
+            step = lambda: download_images(db, config, config.crawler.download_limit, deadline)
+        run_stage(db, MessageStatus.Downloading, step, args.follow, downstream=MessageStatus.Success,
+                  deadline=deadline)
 
 
 if __name__ == '__main__':
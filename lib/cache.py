@@ -8,25 +8,75 @@ from PIL import Image
 
 cache_root = Path('cache')
 
+# Telegram keeps at most 2560px on the long side of a photo and rejects uploads over 10 MB,
+# so renditions are capped well below that and anything larger is wasted upload.
+UPLOAD_MAX_SIDE = 2560
+UPLOAD_BYTE_BUDGET = 2 * 1024 * 1024
+_UPLOAD_QUALITIES = (90, 85, 80, 70, 60)
+
 
 def _get_name_from_id(id_: str) -> str:
     return str(cache_root / f"{id_}.jpg")
 
 
+def _get_rendition_name_from_id(id_: str) -> str:
+    return str(cache_root / f"{id_}.upload.jpg")
+
+
+def _encode_rendition(img: Image.Image) -> bytes:
+    while True:
+        for q in _UPLOAD_QUALITIES:
+            bio = BytesIO()
+            img.save(bio, format='JPEG', quality=q, optimize=True)
+            if bio.tell() <= UPLOAD_BYTE_BUDGET:
+                return bio.getvalue()
+        w, h = img.size
+        img = img.resize((max(w * 3 // 4, 1), max(h * 3 // 4, 1)), Image.LANCZOS)
+
+
+def _save_rendition(img: Image.Image, fp: str):
+    img.thumbnail((UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE), Image.LANCZOS, reducing_gap=3.0)
+    with open(fp, 'wb') as f:
+        f.write(_encode_rendition(img))
+
+
 def add_cache(io: IO) -> str:
     id_ = str(uuid.uuid4())
-    img: Image.Image = Image.open(io)
-    img = img.convert("RGB")
+    raw = io.read()
+    img: Image.Image = Image.open(BytesIO(raw))
     fp = _get_name_from_id(id_)
-    img.save(fp, format='JPEG')
+    if img.format == 'JPEG' and img.mode in ('RGB', 'L'):
+        # Keep the original bytes for WebDAV and let the decoder downscale in the DCT domain.
+        with open(fp, 'wb') as f:
+            f.write(raw)
+        if max(img.size) <= UPLOAD_MAX_SIDE and len(raw) <= UPLOAD_BYTE_BUDGET:
+            return id_
+        img.draft('RGB', (UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE))
+        img = img.convert("RGB")
+    else:
+        img = img.convert("RGB")
+        img.save(fp, format='JPEG')
+        if max(img.size) <= UPLOAD_MAX_SIDE and os.path.getsize(fp) <= UPLOAD_BYTE_BUDGET:
+            return id_
+    _save_rendition(img, _get_rendition_name_from_id(id_))
     return id_
 
 
 def read_cache(id_: str) -> IO:
     return open(_get_name_from_id(id_), 'rb')
 
+
+def read_upload(id_: str) -> IO:
+    fp = _get_rendition_name_from_id(id_)
+    if os.path.exists(fp):
+        return open(fp, 'rb')
+    return read_cache(id_)
+
 def cache_path(id_: str) -> str:
     return _get_name_from_id(id_)
 
 def remove_cache(id_: str):
     os.remove(_get_name_from_id(id_))
+    fp = _get_rendition_name_from_id(id_)
+    if os.path.exists(fp):
+        os.remove(fp)
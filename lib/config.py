@@ -24,12 +24,20 @@ class CrawlerConfig(NamedTuple):
     cool_down_time: int
     download_limit: int
     post_limit: int
+    retry_base_delay: int = 30
+    retry_max_delay: int = 3600
 
 
 class RedisConfig(NamedTuple):
     host: str
     port: int
     db: int
+    queue_backend: str = 'list'
+    consumer: Optional[str] = None
+    claim_idle_ms: int = 600000
+    cluster_nodes: Optional[List[str]] = None
+    hash_shards: int = 1
+    poll_batch_size: int = 100
 
 
 class TwitterConfig(NamedTuple):
@@ -37,6 +45,12 @@ class TwitterConfig(NamedTuple):
     consumer_secret: str
     access_key: str
     access_secret: str
+    stream_url: str = 'https://stream.twitter.com/1.1/statuses/filter.json'
+
+
+class PixivConfig(NamedTuple):
+    refresh_token: str = ''
+    api_host: Optional[str] = None
 
 
 class TelegramConfig(NamedTuple):
@@ -53,6 +67,7 @@ class UConfig(NamedTuple):
     redis: RedisConfig
     crawler: CrawlerConfig
     manage: ManageConfig
+    pixiv: Optional[PixivConfig] = None
 
 
 def parse(f: IO) -> UConfig:
@@ -63,5 +78,6 @@ def parse(f: IO) -> UConfig:
         redis=RedisConfig(**d['redis']),
         crawler=CrawlerConfig(**d['crawler']),
         manage=ManageConfig(**d['manage']),
-        webdav=WebDavConfig(**d['webdav'])
+        webdav=WebDavConfig(**d['webdav']),
+        pixiv=PixivConfig(**d['pixiv']) if 'pixiv' in d else None
     )
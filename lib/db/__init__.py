@@ -1,2 +1,3 @@
 from .udb import UDB, connect_db
+from .audb import AsyncUDB, connect_async_db
 from .versions import CURRENT_VERSION, migrate_db, get_db_version
@@ -0,0 +1,593 @@
+import asyncio
+import inspect
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import AnyStr, Optional, List, Dict, AsyncIterator, Callable, Any, Awaitable, Iterable, Tuple
+
+import redis.asyncio
+
+from lib.config import RedisConfig, CrawlerConfig
+from lib.phash import HASH_BYTES
+from lib.utils import UMessage, MessageStatus, MessageType, TargetType
+from .events import LifecycleEvent, append_event, parse_event, default_worker, error_class
+from .fair_queue import FairQueue
+from .image_hashes import HASH_LOG_COUNT, HASH_LOG_RANGE
+from .names import *
+from .notify import AsyncStageNotifier
+from .retry import RetryBackoff, DelayedQueue
+from .search import index_message, query_keys, char_union_keys, RESULT_TTL
+from .stream_queue import StreamQueue, drive_async
+from .udb import StageQueue, _stage_queue, _batch_limit
+from .utils import ENCODING, RBQueue
+from .versions import check_version, parse_checkpoint, CURRENT_VERSION
+
+_pools: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[RedisConfig, redis.asyncio.ConnectionPool]]' = \
+    weakref.WeakKeyDictionary()
+
+
+def connect_async_db(config: RedisConfig) -> redis.asyncio.Redis:
+    if config.cluster_nodes:
+        raise ValueError("AsyncUDB does not support cluster mode yet")
+    configure_layout(False, config.hash_shards)
+    # Connections belong to the event loop they were opened on, so every AsyncUDB of one loop
+    # shares a pool per server and a new loop (another asyncio.run) starts its own.
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return redis.asyncio.Redis(host=config.host, port=config.port, db=config.db)
+    pools = _pools.setdefault(loop, {})
+    pool = pools.get(config)
+    if pool is None:
+        pool = redis.asyncio.ConnectionPool(host=config.host, port=config.port, db=config.db)
+        pools[config] = pool
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+async def _resolve(res):
+    # Pipelined queue writes are plain calls, except Lua-backed ones which return a coroutine.
+    if inspect.iscoroutine(res):
+        await res
+
+
+class AsyncUDB:
+    """
+    asyncio counterpart of ``UDB`` on ``redis.asyncio``, with the same key layout, queue
+    backends and lifecycle events. Create it with ``await AsyncUDB.connect(config)``.
+    It covers what crawlers, stage workers and bots call; maintenance operations (``recover``,
+    ``requeue_failed``, ``monitor_reindex``, search index rebuilds) stay on ``UDB`` and run
+    from their scripts.
+    """
+    version = '0'
+    conn: redis.asyncio.Redis
+    download_queue: StageQueue
+    post_queue: StageQueue
+    success_queue: StageQueue
+    cleaned_queue: RBQueue
+    failed_queue: RBQueue
+    worker: str
+    backoff: RetryBackoff
+    poll_batch_size: int
+    _status_to_queue: Dict[MessageStatus, StageQueue]
+    _delayed: Dict[MessageStatus, DelayedQueue]
+
+    def __init__(self, config: RedisConfig, worker: Optional[str] = None, crawler: Optional[CrawlerConfig] = None):
+        self.conn = connect_async_db(config)
+        self.worker = worker or default_worker()
+        self.poll_batch_size = config.poll_batch_size
+        if crawler is None:
+            self.backoff = RetryBackoff()
+        else:
+            self.backoff = RetryBackoff(crawler.retry_base_delay, crawler.retry_max_delay)
+        self.download_queue = _stage_queue(self.conn, config, DOWNLOAD_QUEUE, DOWNLOAD_STREAM, DOWNLOAD_FAIR_QUEUE)
+        self.post_queue = _stage_queue(self.conn, config, POST_QUEUE, POST_STREAM, POST_FAIR_QUEUE)
+        self.success_queue = _stage_queue(self.conn, config, SUCCESS_QUEUE, SUCCESS_STREAM)
+        self.cleaned_queue = RBQueue(self.conn, CLEANED_QUEUE)
+        self.failed_queue = RBQueue(self.conn, FAILED_QUEUE)
+        self._status_to_queue = {
+            MessageStatus.Downloading: self.download_queue,
+            MessageStatus.Posting: self.post_queue,
+            MessageStatus.Failed: self.failed_queue,
+            MessageStatus.Success: self.success_queue,
+            MessageStatus.Cleaned: self.cleaned_queue
+        }
+        self._delayed = {
+            s: DelayedQueue(self.conn, delayed_retry_key(s))
+            for s in (MessageStatus.Downloading, MessageStatus.Posting, MessageStatus.Success)
+        }
+        self._hash_log_count = self.conn.register_script(HASH_LOG_COUNT)
+        self._hash_log_range = self.conn.register_script(HASH_LOG_RANGE)
+
+    @classmethod
+    async def connect(cls, config: RedisConfig, worker: Optional[str] = None,
+                      crawler: Optional[CrawlerConfig] = None) -> 'AsyncUDB':
+        db = cls(config, worker, crawler)
+        for q in db._status_to_queue.values():
+            if isinstance(q, FairQueue):
+                await asyncio.gather(*q.load())
+        v = await db.conn.get(VERSION)
+        if v is not None and v.decode(ENCODING) != CURRENT_VERSION:
+            v = v.decode(ENCODING)
+            check_version(v, parse_checkpoint(await db.conn.hgetall(migration_key(v, CURRENT_VERSION))))
+        return db
+
+    @asynccontextmanager
+    async def _transition(self, uid: AnyStr, stage: str, status: MessageStatus,
+                          error: Optional[BaseException] = None) -> AsyncIterator[redis.asyncio.client.Pipeline]:
+        async with self.conn.pipeline() as p:
+            yield p
+            append_event(p, uid, stage, status, self.worker, error_class(error))
+            p.publish(notify_channel(status), uid)
+            await p.execute()
+
+    async def _schedule_retry(self, p: redis.asyncio.client.Pipeline, uid: AnyStr, status: MessageStatus):
+        at = time.time() + self.backoff.delay(await self.get_retry(uid))
+        self._delayed[status].bind(p).schedule(uid, at)
+        p.incr(retry_count_key(uid))
+
+    async def _pop(self, q: StageQueue) -> Optional[str]:
+        res = await self._pop_many(q, 1)
+        if res:
+            return res[0]
+
+    async def _pop_many(self, q: StageQueue, n: int) -> List[str]:
+        if isinstance(q, FairQueue):
+            return [b.decode(ENCODING) for b in await q._pop_raw(n)]
+        elif isinstance(q, StreamQueue):
+            return await drive_async(self.conn, q._pop_steps(n))
+        return [b.decode(ENCODING) for b in await self.conn.rpop(q.queue_key, n) or []]
+
+    def poll_batch_limit(self, status: MessageStatus) -> int:
+        return _batch_limit(self._status_to_queue[status], self.poll_batch_size)
+
+    def iter_poll(self, status: MessageStatus, limit: Optional[int] = None,
+                  batch_size: Optional[int] = None) -> AsyncIterator[UMessage]:
+        return self._iter_poll(status, limit, batch_size)
+
+    async def push_back(self, status: MessageStatus, uids: List[str]):
+        if not uids:
+            return
+        async with self.conn.pipeline(transaction=False) as p:
+            for uid in uids:
+                p.get(status_key(uid))
+                p.zscore(delayed_retry_key(status), uid)
+            res = await p.execute()
+        current = status.value.encode(ENCODING)
+        uids = [uid for uid, s, delayed in zip(uids, res[::2], res[1::2]) if s == current and delayed is None]
+        if not uids:
+            return
+        async with self.conn.pipeline() as p:
+            self._status_to_queue[status].bind(p).push_back(uids)
+            await p.execute()
+
+    async def next_retry_in(self, status: MessageStatus) -> Optional[float]:
+        res = await self.conn.zrange(delayed_retry_key(status), 0, 0, withscores=True)
+        if res:
+            return max(res[0][1] - time.time(), 0)
+
+    def subscribe(self, *statuses: MessageStatus) -> AsyncStageNotifier:
+        return AsyncStageNotifier(self.conn, statuses)
+
+    async def stage_cost_get(self, status: MessageStatus) -> Optional[float]:
+        c = await self.conn.get(stage_cost_key(status))
+        if c is not None:
+            return float(c)
+
+    async def stage_cost_set(self, status: MessageStatus, seconds: float):
+        await self.conn.set(stage_cost_key(status), str(seconds).encode(ENCODING))
+
+    async def _size(self, q: StageQueue) -> int:
+        if isinstance(q, FairQueue):
+            return int(await self.conn.get(q.size_key) or 0)
+        elif isinstance(q, StreamQueue):
+            return await self.conn.xlen(q.queue_key)
+        return await self.conn.llen(q.queue_key)
+
+    async def _poll(self, status: MessageStatus) -> Optional[UMessage]:
+        await self.promote_retries(status)
+        uid = await self._pop(self._status_to_queue[status])
+        if uid is not None:
+            return await self.get_data(uid)
+
+    async def _iter_poll(self, status: MessageStatus, limit: Optional[int],
+                         batch_size: Optional[int]) -> AsyncIterator[UMessage]:
+        await self.promote_retries(status)
+        q = self._status_to_queue[status]
+        batch_size = _batch_limit(q, batch_size or self.poll_batch_size)
+        remaining = -1 if limit is None else limit
+        while remaining != 0:
+            n = batch_size if remaining < 0 else min(batch_size, remaining)
+            uids = await self._pop_many(q, n)
+            for uid, m in zip(uids, await self.get_data_many(uids)):
+                if m is not None:
+                    yield m
+                else:
+                    async with self.conn.pipeline() as p:
+                        q.bind(p).ack(uid)
+                        await p.execute()
+            if len(uids) < n:
+                break
+            if remaining > 0:
+                remaining -= n
+
+    async def promote_retries(self, status: MessageStatus, limit: int = 1000) -> int:
+        due = [b.decode(ENCODING) for b in await self._delayed[status]._claim_raw(limit)]
+        if due:
+            async with self.conn.pipeline() as p:
+                q = self._status_to_queue[status].bind(p)
+                for uid in due:
+                    await _resolve(q.push(uid))
+                p.publish(notify_channel(status), len(due))
+                await p.execute()
+        return len(due)
+
+    async def retry_count(self) -> int:
+        return sum([await self.conn.zcard(d.queue_key) for d in self._delayed.values()])
+
+    async def download_add(self, data: UMessage):
+        async with self._transition(data.uid, 'download_add', MessageStatus.Downloading) as p:
+            p.set(data_key(data.uid), data.stringify().encode(ENCODING))
+            p.set(status_key(data.uid), MessageStatus.Downloading.value.encode(ENCODING))
+            await _resolve(self.download_queue.bind(p).push(data.uid))
+            index_message(p, data)
+
+    async def download_add_many(self, msgs: Iterable[UMessage]) -> List[UMessage]:
+        batch = list({m.uid: m for m in msgs}.values())
+        if not batch:
+            return []
+        async with self.conn.pipeline() as p:
+            while True:
+                try:
+                    await p.watch(*[data_key(m.uid) for m in batch])
+                    exists = await self.data_exists_many(m.uid for m in batch)
+                    new = [m for m, e in zip(batch, exists) if not e]
+                    if not new:
+                        return []
+                    p.multi()
+                    q = self.download_queue.bind(p)
+                    for m in new:
+                        p.set(data_key(m.uid), m.stringify().encode(ENCODING))
+                        p.set(status_key(m.uid), MessageStatus.Downloading.value.encode(ENCODING))
+                        await _resolve(q.push(m.uid))
+                        index_message(p, m)
+                        append_event(p, m.uid, 'download_add', MessageStatus.Downloading, self.worker, None)
+                    p.publish(notify_channel(MessageStatus.Downloading), len(new))
+                    await p.execute()
+                    return new
+                except redis.WatchError:
+                    continue
+
+    async def download_poll(self) -> Optional[UMessage]:
+        return await self._poll(MessageStatus.Downloading)
+
+    def download_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> AsyncIterator[UMessage]:
+        return self._iter_poll(MessageStatus.Downloading, limit, batch_size)
+
+    async def download_count(self) -> int:
+        return await self._size(self.download_queue)
+
+    async def download_retry(self, uid: AnyStr, error: Optional[BaseException] = None):
+        async with self._transition(uid, 'download_retry', MessageStatus.Downloading, error) as p:
+            p.set(status_key(uid), MessageStatus.Downloading.value.encode(ENCODING))
+            self.download_queue.bind(p).ack(uid)
+            await self._schedule_retry(p, uid, MessageStatus.Downloading)
+
+    async def post_add(self, uid: AnyStr):
+        await self.assert_status(uid, MessageStatus.Downloading)
+        async with self._transition(uid, 'post_add', MessageStatus.Posting) as p:
+            p.set(status_key(uid), MessageStatus.Posting.value.encode(ENCODING))
+            self.download_queue.bind(p).ack(uid)
+            await _resolve(self.post_queue.bind(p).push(uid))
+
+    async def post_poll(self) -> Optional[UMessage]:
+        return await self._poll(MessageStatus.Posting)
+
+    def post_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> AsyncIterator[UMessage]:
+        return self._iter_poll(MessageStatus.Posting, limit, batch_size)
+
+    async def post_count(self) -> int:
+        return await self._size(self.post_queue)
+
+    async def post_retry(self, uid: AnyStr, error: Optional[BaseException] = None):
+        await self.assert_status(uid, MessageStatus.Posting)
+        async with self._transition(uid, 'post_retry', MessageStatus.Posting, error) as p:
+            self.post_queue.bind(p).ack(uid)
+            await self._schedule_retry(p, uid, MessageStatus.Posting)
+
+    async def add_success(self, uid: AnyStr):
+        await self.assert_status(uid, MessageStatus.Posting)
+        async with self._transition(uid, 'add_success', MessageStatus.Success) as p:
+            p.set(status_key(uid), MessageStatus.Success.value.encode(ENCODING))
+            self.post_queue.bind(p).ack(uid)
+            await _resolve(self.success_queue.bind(p).push(uid))
+
+    async def success_poll(self) -> Optional[UMessage]:
+        return await self._poll(MessageStatus.Success)
+
+    def success_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> AsyncIterator[UMessage]:
+        return self._iter_poll(MessageStatus.Success, limit, batch_size)
+
+    async def success_count(self) -> int:
+        return await self._size(self.success_queue)
+
+    async def clean(self, uid: AnyStr):
+        await self.assert_status(uid, MessageStatus.Success)
+        async with self._transition(uid, 'clean', MessageStatus.Cleaned) as p:
+            p.set(status_key(uid), MessageStatus.Cleaned.value.encode(ENCODING))
+            self.success_queue.bind(p).ack(uid)
+            self.cleaned_queue.bind(p).push(uid)
+
+    async def clean_count(self) -> int:
+        return await self.conn.llen(self.cleaned_queue.queue_key)
+
+    async def clean_retry(self, uid: str, error: Optional[BaseException] = None):
+        async with self._transition(uid, 'clean_retry', MessageStatus.Success, error) as p:
+            p.set(status_key(uid), MessageStatus.Success.value.encode(ENCODING))
+            self.success_queue.bind(p).ack(uid)
+            await self._schedule_retry(p, uid, MessageStatus.Success)
+
+    async def fail(self, uid: AnyStr, error: Optional[BaseException] = None):
+        current_status = await self.get_status(uid)
+        async with self._transition(uid, 'fail', MessageStatus.Failed, error) as p:
+            p.set(status_key(uid), MessageStatus.Failed.value.encode(ENCODING))
+            self._status_to_queue[current_status].bind(p).ack(uid)
+            self.failed_queue.bind(p).push(uid)
+            p.set(get_failure_status(uid), current_status.value.encode(ENCODING))
+            p.set(failure_time_key(uid), str(time.time()).encode(ENCODING))
+
+    async def set_failure_status(self, uid: AnyStr, status: MessageStatus):
+        await self.conn.set(get_failure_status(uid), status.value.encode(ENCODING))
+
+    async def get_failure_status(self, uid: AnyStr) -> MessageStatus:
+        return MessageStatus((await self.conn.get(get_failure_status(uid))).decode(ENCODING))
+
+    async def failed_count(self) -> int:
+        return await self.conn.llen(self.failed_queue.queue_key)
+
+    async def set_status(self, uid: AnyStr, status: MessageStatus):
+        await self.conn.set(status_key(uid), status.value.encode(ENCODING))
+
+    async def get_status(self, uid) -> MessageStatus:
+        return MessageStatus((await self.conn.get(status_key(uid))).decode(ENCODING))
+
+    async def put_data(self, msg: UMessage):
+        await self.conn.set(data_key(msg.uid), msg.stringify().encode(ENCODING))
+
+    async def get_data(self, uid: AnyStr) -> UMessage:
+        d = await self.conn.get(data_key(uid))
+        return UMessage.parse(d.decode(ENCODING))
+
+    async def get_data_many(self, uids: Iterable[AnyStr]) -> List[Optional[UMessage]]:
+        uids = list(uids)
+        if not uids:
+            return []
+        return [
+            UMessage.parse(d.decode(ENCODING)) if d is not None else None
+            for d in await self.conn.mget([data_key(u) for u in uids])
+        ]
+
+    async def data_exists(self, uid: AnyStr) -> bool:
+        return await self.conn.exists(data_key(uid)) == 1
+
+    async def data_exists_many(self, uids: Iterable[AnyStr]) -> List[bool]:
+        async with self.conn.pipeline(transaction=False) as p:
+            for u in uids:
+                p.exists(data_key(u))
+            return [r == 1 for r in await p.execute()]
+
+    async def monitor_add(self, type_: MessageType, name: str):
+        await self.monitor_add_many(type_, [name])
+
+    async def monitor_add_many(self, type_: MessageType, names: Iterable[str]):
+        names = [n.encode(ENCODING) for n in names]
+        if not names:
+            return
+        async with self.conn.pipeline() as p:
+            p.sadd(monitor_key(type_), *names)
+            p.zadd(monitor_index_key(type_), dict.fromkeys(names, 0))
+            await p.execute()
+
+    async def monitor_list(self, type_: MessageType) -> List[str]:
+        return [
+            s.decode(ENCODING)
+            for s in await self.conn.smembers(monitor_key(type_))
+        ]
+
+    async def monitor_remove(self, type_: MessageType, name: str):
+        await self.monitor_remove_many(type_, [name])
+
+    async def monitor_remove_many(self, type_: MessageType, names: Iterable[str]):
+        names = [n.encode(ENCODING) for n in names]
+        if not names:
+            return
+        async with self.conn.pipeline() as p:
+            p.srem(monitor_key(type_), *names)
+            p.zrem(monitor_index_key(type_), *names)
+            await p.execute()
+
+    async def monitor_count(self, type_: MessageType) -> int:
+        return await self.conn.scard(monitor_key(type_))
+
+    async def monitor_page(self, type_: MessageType, prefix: str = '', after: Optional[str] = None,
+                           limit: int = 100) -> List[str]:
+        p = prefix.encode(ENCODING)
+        lo = b'(' + after.encode(ENCODING) if after is not None and after >= prefix else b'[' + p
+        hi = b'[' + p + b'\xff' if p else b'+'
+        return [
+            s.decode(ENCODING)
+            for s in await self.conn.zrangebylex(monitor_index_key(type_), lo, hi, start=0, num=limit)
+        ]
+
+    async def monitor_weight_set(self, type_: MessageType, name: str, weight: float):
+        field = monitor_weight_field(type_, name).encode(ENCODING)
+        if weight == 1:
+            await self.conn.hdel(MONITOR_WEIGHT, field)
+        else:
+            await self.conn.hset(MONITOR_WEIGHT, field, str(weight).encode(ENCODING))
+
+    async def monitor_weights(self, type_: MessageType) -> Dict[str, float]:
+        prefix = monitor_weight_field(type_, '')
+        return {
+            k.decode(ENCODING)[len(prefix):]: float(v.decode(ENCODING))
+            for k, v in (await self.conn.hgetall(MONITOR_WEIGHT)).items()
+            if k.decode(ENCODING).startswith(prefix)
+        }
+
+    async def queue_counts(self) -> Dict[str, int]:
+        async with self.conn.pipeline(transaction=False) as p:
+            for q in (self.download_queue, self.post_queue, self.success_queue):
+                if isinstance(q, FairQueue):
+                    p.get(q.size_key)
+                elif isinstance(q, StreamQueue):
+                    p.xlen(q.queue_key)
+                else:
+                    p.llen(q.queue_key)
+            p.llen(self.cleaned_queue.queue_key)
+            p.llen(self.failed_queue.queue_key)
+            for d in self._delayed.values():
+                p.zcard(d.queue_key)
+            res = [int(r or 0) for r in await p.execute()]
+        return dict(
+            download=res[0],
+            post=res[1],
+            success=res[2],
+            cleaned=res[3],
+            failed=res[4],
+            retrying=sum(res[5:])
+        )
+
+    async def since_id_get(self, type_: MessageType) -> Optional[int]:
+        d = await self.conn.get(since_id_key(type_))
+        if d is not None:
+            return int(d)
+
+    async def since_id_set(self, type_: MessageType, id_: int):
+        await self.conn.set(since_id_key(type_), str(id_).encode(ENCODING))
+
+    async def relation_add(self, type_: MessageType, src: str, dst: str, status_id: str) -> int:
+        key = merge_rel_key(src, dst)
+        name = relation_key(type_, key)
+        async with self.conn.pipeline(transaction=False) as p:
+            p.sadd(relation_id_key(type_, status_id), status_id.encode(ENCODING))
+            p.hget(name, key)
+            added, c = await p.execute()
+        # SADD reports whether the status id is new, which is what the count is bumped on.
+        if added:
+            return await self.conn.hincrby(name, key, 1)
+        return int(c or 0)
+
+    async def relation_query(self, type_: MessageType) -> Dict[Tuple[str, str], int]:
+        return {
+            split_rel_key(k.decode(ENCODING)): int(v.decode(ENCODING))
+            for name in relation_keys(type_)
+            async for k, v in self.conn.hscan_iter(name)
+        }
+
+    async def _expand_chars(self, chars: List[str]):
+        if not chars:
+            return
+        async with self.conn.pipeline(transaction=False) as p:
+            for c in chars:
+                p.exists(search_char_key(c))
+                p.smembers(search_vocab_key(c))
+            res = await p.execute()
+        async with self.conn.pipeline() as p:
+            for c, cached, bigrams in zip(chars, res[::2], res[1::2]):
+                if not cached:
+                    p.zunionstore(search_char_key(c), char_union_keys(c, bigrams), aggregate='MAX')
+                    p.expire(search_char_key(c), RESULT_TTL)
+            await p.execute()
+
+    async def search(self, query: str, offset: int = 0, limit: int = 10) -> Tuple[int, List[UMessage]]:
+        keys, chars = query_keys(query)
+        if not keys:
+            return 0, []
+        await self._expand_chars(chars)
+        async with self.conn.pipeline() as p:
+            if len(keys) == 1:
+                k = keys[0]
+            else:
+                k = search_result_key(keys)
+                p.exists(k)
+            p.zcard(k)
+            p.zrevrange(k, offset, offset + limit - 1)
+            res = await p.execute()
+        total, uids = res[-2], res[-1]
+        if len(keys) > 1 and not res[0]:
+            async with self.conn.pipeline() as p:
+                p.zinterstore(k, keys, aggregate='MAX')
+                p.expire(k, RESULT_TTL)
+                p.zrevrange(k, offset, offset + limit - 1)
+                total, _, uids = await p.execute()
+        return total, [m for m in await self.get_data_many(u.decode(ENCODING) for u in uids) if m is not None]
+
+    async def add_file(self, url: str, path: str):
+        await self.conn.hset(url_to_file_key(url), url.encode(ENCODING), str(path).encode(ENCODING))
+
+    async def get_file(self, url: str) -> Optional[str]:
+        d = await self.conn.hget(url_to_file_key(url), url.encode(ENCODING))
+        if d is not None:
+            return d.decode(ENCODING)
+
+    async def remove_file(self, url: str):
+        await self.conn.hdel(url_to_file_key(url), url.encode(ENCODING))
+
+    async def image_hash_add(self, uid: str, hashes: Iterable[bytes]):
+        records = [h + uid.encode(ENCODING) for h in hashes]
+        if records:
+            await self.conn.rpush(IMAGE_HASH_LOG, *records)
+
+    async def image_hash_count(self) -> int:
+        return await self._hash_log_count(keys=[IMAGE_HASH_LOG, IMAGE_HASH_OFFSET])
+
+    async def image_hash_range(self, start: int, end: int = -1) -> List[Tuple[bytes, str]]:
+        return [
+            (r[:HASH_BYTES], r[HASH_BYTES:].decode(ENCODING))
+            for r in await self._hash_log_range(keys=[IMAGE_HASH_LOG, IMAGE_HASH_OFFSET], args=[start, end])
+        ]
+
+    async def retry_or_fail(self, uid: AnyStr,
+                            retry_func: Callable[[AnyStr, Optional[BaseException]], Awaitable[Any]], limit: int,
+                            error: Optional[BaseException] = None):
+        if await self.get_retry(uid) < limit:
+            await retry_func(uid, error)
+        else:
+            await self.fail(uid, error)
+
+    async def inc_retry(self, uid: AnyStr):
+        await self.conn.incr(retry_count_key(uid))
+
+    async def get_retry(self, uid: AnyStr) -> int:
+        c = await self.conn.get(retry_count_key(uid)) or b'0'
+        return int(c.decode(ENCODING))
+
+    async def assert_status(self, uid: AnyStr, expected: MessageStatus):
+        status = await self.get_status(uid)
+        if status == MessageStatus.Failed and expected != MessageStatus.Failed:
+            status = await self.get_failure_status(uid)
+        if status != expected:
+            raise RuntimeError(f"Invalid status for uid={uid}, expected: {expected.value}, actual: {status.value}")
+
+    async def events(self, uid: AnyStr, count: Optional[int] = None) -> List[LifecycleEvent]:
+        return [
+            parse_event(eid, fields)
+            for eid, fields in await self.conn.xrange(event_key(uid), count=count)
+        ]
+
+    async def reversed_index_add(self, type_: TargetType, tid, uid):
+        await self.conn.hset(reversed_index_key(type_, tid), tid.encode(ENCODING), uid.encode(ENCODING))
+
+    async def reversed_index_get(self, type_: TargetType, tid) -> Optional[UMessage]:
+        uid = await self.conn.hget(reversed_index_key(type_, tid), tid.encode(ENCODING))
+        if uid is None:
+            return None
+        return await self.get_data(uid.decode(ENCODING))
+
+    async def close(self):
+        await self.conn.aclose()
+
+    async def __aenter__(self) -> 'AsyncUDB':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -0,0 +1,68 @@
+import os
+import socket
+import sys
+from typing import NamedTuple, Optional, List
+
+import redis
+
+from lib.utils import MessageStatus
+from .names import event_key
+from .utils import ENCODING
+
+EVENT_LOG_MAXLEN = 64
+EVENT_LOG_TTL = 14 * 24 * 3600
+
+
+class LifecycleEvent(NamedTuple):
+    id: str
+    timestamp: float
+    stage: str
+    status: MessageStatus
+    worker: str
+    error: Optional[str]
+
+
+def default_worker() -> str:
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+    return f"{script}@{socket.gethostname()}:{os.getpid()}"
+
+
+def error_class(err: Optional[BaseException]) -> Optional[str]:
+    if err is None:
+        return None
+    return type(err).__name__
+
+
+def append_event(conn: redis.Redis, uid: str, stage: str, status: MessageStatus, worker: str,
+                 error: Optional[str] = None):
+    # The entry id carries the timestamp, so only the remaining fields are stored.
+    fields = {
+        b's': stage.encode(ENCODING),
+        b'st': status.value.encode(ENCODING),
+        b'w': worker.encode(ENCODING),
+    }
+    if error is not None:
+        fields[b'e'] = error.encode(ENCODING)
+    k = event_key(uid)
+    conn.xadd(k, fields, maxlen=EVENT_LOG_MAXLEN, approximate=True)
+    conn.expire(k, EVENT_LOG_TTL)
+
+
+def parse_event(eid: bytes, fields: dict) -> LifecycleEvent:
+    eid = eid.decode(ENCODING)
+    error = fields.get(b'e')
+    return LifecycleEvent(
+        id=eid,
+        timestamp=int(eid.split('-')[0]) / 1000,
+        stage=fields[b's'].decode(ENCODING),
+        status=MessageStatus(fields[b'st'].decode(ENCODING)),
+        worker=fields[b'w'].decode(ENCODING),
+        error=error.decode(ENCODING) if error is not None else None
+    )
+
+
+def read_events(conn: redis.Redis, uid: str, count: Optional[int] = None) -> List[LifecycleEvent]:
+    return [
+        parse_event(eid, fields)
+        for eid, fields in conn.xrange(event_key(uid), count=count)
+    ]
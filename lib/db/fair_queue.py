@@ -0,0 +1,185 @@
+import asyncio
+from typing import Optional, List, Iterable
+
+import redis
+import redis.asyncio
+from redis.commands.core import Script
+from redis.exceptions import NoScriptError
+
+from .names import DATA_PREFIX
+from .utils import ENCODING
+
+# Sub-queues are keyed by the type and monitor of the message, read from its data record so callers
+# can keep pushing bare uids. A monitor is on the ring exactly while its sub-queue is non-empty.
+_PUSH = """
+local uid = ARGV[3]
+local group = '_'
+local raw = redis.call('GET', ARGV[2] .. ':' .. uid)
+if raw then
+    local ok, d = pcall(cjson.decode, raw)
+    if ok and type(d) == 'table' and d['monitor'] then
+        group = tostring(d['type']) .. ':' .. tostring(d['monitor'])
+    end
+end
+if ARGV[4] == '1' then
+    -- Pushed back: ahead of the sub-queue, and the monitor ahead on the ring if it just joined.
+    if redis.call('RPUSH', ARGV[1] .. ':' .. group, uid) == 1 then
+        redis.call('LPUSH', KEYS[1], group)
+    end
+elseif redis.call('LPUSH', ARGV[1] .. ':' .. group, uid) == 1 then
+    redis.call('RPUSH', KEYS[1], group)
+end
+redis.call('INCR', KEYS[2])
+"""
+
+# Deficit round-robin: the monitor at the head of the ring earns its weight (default 1) as
+# quantum when its deficit is spent, is served while the deficit covers one item, then rotates.
+_POP = """
+local out = {}
+local n = tonumber(ARGV[2])
+local rounds = 0
+while #out < n and rounds < 10000 do
+    rounds = rounds + 1
+    local group = redis.call('LINDEX', KEYS[1], 0)
+    if not group then
+        break
+    end
+    local q = ARGV[1] .. ':' .. group
+    local d = tonumber(redis.call('HGET', KEYS[3], group) or '0')
+    if d < 1 then
+        d = d + tonumber(redis.call('HGET', KEYS[4], group) or '1')
+    end
+    while d >= 1 and #out < n do
+        local uid = redis.call('RPOP', q)
+        if not uid then
+            break
+        end
+        out[#out + 1] = uid
+        d = d - 1
+    end
+    if redis.call('LLEN', q) == 0 then
+        redis.call('LPOP', KEYS[1])
+        redis.call('HDEL', KEYS[3], group)
+    else
+        redis.call('HSET', KEYS[3], group, tostring(d))
+        if d < 1 then
+            redis.call('RPUSH', KEYS[1], redis.call('LPOP', KEYS[1]))
+        end
+    end
+end
+if #out > 0 then
+    redis.call('DECRBY', KEYS[2], #out)
+end
+return out
+"""
+
+
+class FairQueue:
+    """
+    Stage queue split into one FIFO sub-queue per monitor, drained by deficit round-robin so a
+    prolific monitor can not starve the others. Per-monitor weights are read from ``weight_key``.
+    """
+    conn: redis.Redis
+    queue_key: str
+    weight_key: str
+
+    def __init__(self, conn: redis.Redis, queue_key: str, weight_key: str,
+                 _scripts: Optional[List[Script]] = None, _pipelined: bool = False):
+        self.conn = conn
+        self.queue_key = queue_key
+        self.weight_key = weight_key
+        if _scripts is None:
+            _scripts = [conn.register_script(_PUSH), conn.register_script(_POP)]
+        self._scripts = _scripts
+        self._pipelined = _pipelined
+
+    def load(self):
+        # Called once at startup: pipelines then run the scripts by EVALSHA, without the SCRIPT EXISTS
+        # round trip redis-py adds to every pipeline holding a Script. A Redis restart forgets them;
+        # the next direct pop loads them again, and recover() repairs transitions that failed meanwhile. Returns the calls so an asyncio client can await them.
+        return [self.conn.script_load(s.script) for s in self._scripts]
+
+    @property
+    def _ring_key(self) -> str:
+        return f"{self.queue_key}.ring"
+
+    @property
+    def size_key(self) -> str:
+        return f"{self.queue_key}.size"
+
+    @property
+    def _deficit_key(self) -> str:
+        return f"{self.queue_key}.deficit"
+
+    def bind(self, conn: redis.Redis) -> 'FairQueue':
+        return FairQueue(conn, self.queue_key, self.weight_key, self._scripts, True)
+
+    def _run(self, script: Script, keys: List[str], args: list):
+        # Returns the script call so an asyncio client can await it.
+        if self._pipelined:
+            return self.conn.evalsha(script.sha, len(keys), *keys, *args)
+        if isinstance(self.conn, redis.asyncio.Redis):
+            return self._run_async(script, keys, args)
+        try:
+            return self.conn.evalsha(script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # Load both, so pipelined pushes work again too.
+            self.load()
+            return self.conn.evalsha(script.sha, len(keys), *keys, *args)
+
+    async def _run_async(self, script: Script, keys: List[str], args: list):
+        try:
+            return await self.conn.evalsha(script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            await asyncio.gather(*self.load())
+            return await self.conn.evalsha(script.sha, len(keys), *keys, *args)
+
+    def _push(self, uid: str, front: bool):
+        push, _ = self._scripts
+        return self._run(push, [self._ring_key, self.size_key], [self.queue_key, DATA_PREFIX, uid, int(front)])
+
+    def push(self, uid: str):
+        return self._push(uid, False)
+
+    def _pop_raw(self, n: int):
+        _, pop = self._scripts
+        return self._run(pop, [self._ring_key, self.size_key, self._deficit_key, self.weight_key], [self.queue_key, n])
+
+    def pop_many(self, n: int) -> List[str]:
+        return [b.decode(ENCODING) for b in self._pop_raw(n)]
+
+    def pop(self) -> Optional[str]:
+        res = self.pop_many(1)
+        if res:
+            return res[0]
+
+    def ack(self, uid: str):
+        pass
+
+    def push_back(self, uids: List[str]):
+        # Back onto the popping end of their sub-queues, in the order they were popped.
+        for uid in reversed(uids):
+            self._push(uid, True)
+
+    def size(self):
+        return int(self.conn.get(self.size_key) or 0)
+
+    def empty(self) -> bool:
+        return self.size() == 0
+
+    def iter_pop(self, limit: Optional[int] = None) -> Iterable[str]:
+        if limit is None:
+            limit = -1
+        while limit != 0:
+            d = self.pop()
+            if d is None:
+                break
+            yield d
+            limit -= 1
+
+    def list(self) -> List[str]:
+        return [
+            b.decode(ENCODING)
+            for g in self.conn.lrange(self._ring_key, 0, -1)
+            for b in self.conn.lrange(f"{self.queue_key}:{g.decode(ENCODING)}", 0, -1)
+        ]
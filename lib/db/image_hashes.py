@@ -0,0 +1,29 @@
+# The hash log is trimmed once its head is in the on-disk index. KEYS are the log and the count of
+# records trimmed from it so far, so positions passed in and out stay absolute across trims.
+
+HASH_LOG_COUNT = """
+return tonumber(redis.call('GET', KEYS[2]) or '0') + redis.call('LLEN', KEYS[1])
+"""
+
+# ARGV: first and last position, the last being -1 for the end of the log.
+HASH_LOG_RANGE = """
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+local stop = tonumber(ARGV[2])
+if stop >= 0 then
+    stop = stop - offset
+    if stop < 0 then
+        return {}
+    end
+end
+return redis.call('LRANGE', KEYS[1], math.max(tonumber(ARGV[1]) - offset, 0), stop)
+"""
+
+# ARGV[1]: the position up to which records are in the index and can be dropped.
+HASH_LOG_TRIM = """
+local n = tonumber(ARGV[1]) - tonumber(redis.call('GET', KEYS[2]) or '0')
+if n > 0 then
+    redis.call('LTRIM', KEYS[1], n, -1)
+    redis.call('SET', KEYS[2], ARGV[1])
+end
+return math.max(n, 0)
+"""
@@ -1,11 +1,13 @@
-from typing import Tuple
+import zlib
+from typing import Tuple, List, Optional, AnyStr
 
-from lib.utils import MessageType, TargetType
+from lib.utils import MessageType, TargetType, MessageStatus
 
 VERSION = 'stbot.version'
 DOWNLOAD_QUEUE = 'stbot.queue.download'
 POST_QUEUE = 'stbot.queue.post'
 FAILURE_STATUS_PREFIX = 'stbot.failure.status'
+FAILURE_TIME_PREFIX = 'stbot.failure.time'
 SUCCESS_QUEUE = 'stbot.queue.success'
 CLEANED_QUEUE = 'stbot.queue.clean'
 FAILED_QUEUE = 'stbot.queue.failed'
@@ -14,43 +16,159 @@ RETRY_COUNT_PREFIX = 'stbot.retry'
 DATA_PREFIX = 'stbot.data'
 STATUS_PREFIX = 'stbot.status'
 MONITOR_PREFIX = 'stbot.monitor'
+MONITOR_INDEX_PREFIX = 'stbot.monitor.index'
 URL_TO_FILE = 'stbot.url2file'
+IMAGE_HASH_LOG = 'stbot.image.hashes'
+# Tagged with the log's whole name, which is what the untagged log hashes by, so both share a cluster slot.
+IMAGE_HASH_OFFSET = 'stbot.image.hashes.offset:{stbot.image.hashes}'
 RELATION_PREFIX = 'stbot.relation'
 RELATION_ID_PREFIX = 'stbot.relation.id'
 REVERSED_INDEX_PREFIX = 'stbot.reversed.index'
+DELAYED_RETRY_PREFIX = 'stbot.retry.delayed'
+NOTIFY_PREFIX = 'stbot.notify'
+MIGRATION_PREFIX = 'stbot.migration'
+SEARCH_TERM_PREFIX = 'stbot.search.term'
+SEARCH_AUTHOR_PREFIX = 'stbot.search.author'
+SEARCH_RESULT_PREFIX = 'stbot.search.result'
+SEARCH_VOCAB_PREFIX = 'stbot.search.vocab'
+SEARCH_CHAR_PREFIX = 'stbot.search.char'
+EVENT_PREFIX = 'stbot.events'
+DOWNLOAD_STREAM = 'stbot.stream.download'
+POST_STREAM = 'stbot.stream.post'
+SUCCESS_STREAM = 'stbot.stream.success'
+DOWNLOAD_FAIR_QUEUE = 'stbot.fair.download'
+POST_FAIR_QUEUE = 'stbot.fair.post'
+MONITOR_WEIGHT = 'stbot.monitor.weight'
+SINCE_ID_PREFIX = 'stbot.since'
+STAGE_COST_PREFIX = 'stbot.cost'
+
+# Key layout, set once per process by configure_layout from RedisConfig. The default produces
+# the historical key names; cluster mode adds hash tags and hash_shards splits the big hashes.
+_hash_tags = False
+_hash_shards = 1
+
+
+def configure_layout(hash_tags: bool, hash_shards: int = 1):
+    global _hash_tags, _hash_shards
+    _hash_tags = hash_tags
+    _hash_shards = max(hash_shards, 1)
+
+
+def _tag(s: str) -> str:
+    # Redis Cluster only hashes the part inside the first {...}, so keys with the same tag share a slot.
+    return f"{{{s}}}" if _hash_tags else s
+
+
+def _group(name: str) -> str:
+    return f"{{{name}}}:" if _hash_tags else ''
+
+
+def shard_key(base: str, field: AnyStr, shards: Optional[int] = None) -> str:
+    shards = _hash_shards if shards is None else shards
+    if shards <= 1:
+        return base
+    if isinstance(field, str):
+        field = field.encode('utf-8')
+    return f"{base}:{zlib.crc32(field) % shards}"
+
+
+def shard_keys(base: str, shards: Optional[int] = None) -> List[str]:
+    shards = _hash_shards if shards is None else shards
+    if shards <= 1:
+        return [base]
+    return [f"{base}:{i}" for i in range(shards)]
 
 
 def retry_count_key(uid: str):
-    return f'{RETRY_COUNT_PREFIX}:{uid}'
+    return f'{RETRY_COUNT_PREFIX}:{_tag(uid)}'
+
+
+def delayed_retry_key(status: MessageStatus) -> str:
+    return f"{DELAYED_RETRY_PREFIX}:{status.value}"
+
+
+def stage_cost_key(status: MessageStatus) -> str:
+    return f"{STAGE_COST_PREFIX}:{status.value}"
+
+
+def notify_channel(status: MessageStatus) -> str:
+    return f"{NOTIFY_PREFIX}:{status.value}"
+
+
+def migration_key(from_ver: str, to_ver: str) -> str:
+    return f"{MIGRATION_PREFIX}:{from_ver}:{to_ver}"
+
+
+def search_term_key(token: str) -> str:
+    return f"{SEARCH_TERM_PREFIX}:{_group('search')}{token}"
+
+
+def search_author_key(author: str) -> str:
+    return f"{SEARCH_AUTHOR_PREFIX}:{_group('search')}{author.lower()}"
+
+
+def search_vocab_key(char: str) -> str:
+    return f"{SEARCH_VOCAB_PREFIX}:{_group('search')}{char}"
+
+
+def search_char_key(char: str) -> str:
+    return f"{SEARCH_CHAR_PREFIX}:{_group('search')}{char}"
+
+
+def search_result_key(keys: List[str]) -> str:
+    return f"{SEARCH_RESULT_PREFIX}:{_group('search')}{'|'.join(sorted(keys))}"
 
 
 def data_key(uid: str):
-    return f'{DATA_PREFIX}:{uid}'
+    return f'{DATA_PREFIX}:{_tag(uid)}'
 
 
 def status_key(uid: str):
-    return f'{STATUS_PREFIX}:{uid}'
+    return f'{STATUS_PREFIX}:{_tag(uid)}'
 
 
 def get_failure_status(uid: str) -> str:
-    return f'{FAILURE_STATUS_PREFIX}:{uid}'
+    return f'{FAILURE_STATUS_PREFIX}:{_tag(uid)}'
+
+
+def failure_time_key(uid: str) -> str:
+    return f'{FAILURE_TIME_PREFIX}:{_tag(uid)}'
 
 
 def monitor_key(type_: MessageType) -> str:
-    return f"{MONITOR_PREFIX}:{type_.value}"
+    return f"{MONITOR_PREFIX}:{_tag(type_.value)}"
+
+
+def monitor_index_key(type_: MessageType) -> str:
+    return f"{MONITOR_INDEX_PREFIX}:{_tag(type_.value)}"
 
 
-def relation_key(type_: MessageType) -> str:
-    return f"{RELATION_PREFIX}:{type_.value}"
+def monitor_weight_field(type_: MessageType, name: str) -> str:
+    # Matches the sub-queue group the fair queue scripts derive from a message's data.
+    return f"{type_.value}:{name}"
 
 
-def relation_id_key(type_: MessageType) -> str:
-    return f"{RELATION_ID_PREFIX}:{type_.value}"
+def relation_key(type_: MessageType, rel_key: Optional[str] = None) -> str:
+    base = f"{RELATION_PREFIX}:{type_.value}"
+    return base if rel_key is None else shard_key(base, rel_key)
+
+
+def relation_keys(type_: MessageType) -> List[str]:
+    return shard_keys(relation_key(type_))
+
+
+def relation_id_key(type_: MessageType, status_id: Optional[str] = None) -> str:
+    base = f"{RELATION_ID_PREFIX}:{type_.value}"
+    return base if status_id is None else shard_key(base, status_id)
+
+
+def url_to_file_key(url: str) -> str:
+    return shard_key(URL_TO_FILE, url)
 
 
 def get_uid_from_key(key: str) -> str:
     k_prefix, uid = key.split(":")
-    return uid
+    return uid.strip('{}')
 
 
 def merge_rel_key(src: str, dst: str) -> str:
@@ -62,5 +180,14 @@ def split_rel_key(key: str) -> Tuple[str, str]:
     return src, dst
 
 
-def reversed_index_key(type_: TargetType) -> str:
-    return f"{REVERSED_INDEX_PREFIX}:{type_.value}"
+def reversed_index_key(type_: TargetType, tid: Optional[str] = None) -> str:
+    base = f"{REVERSED_INDEX_PREFIX}:{type_.value}"
+    return base if tid is None else shard_key(base, tid)
+
+
+def event_key(uid: str) -> str:
+    return f"{EVENT_PREFIX}:{_tag(uid)}"
+
+
+def since_id_key(type_: MessageType) -> str:
+    return f"{SINCE_ID_PREFIX}:{type_.value}"
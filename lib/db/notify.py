@@ -0,0 +1,61 @@
+from typing import Iterable
+
+import redis
+import redis.asyncio
+
+from lib.utils import MessageStatus
+from .names import notify_channel
+
+
+class StageNotifier:
+    """
+    Wakes a worker up when uids are pushed to the stages it follows. Subscribe before the first
+    poll: anything published while the worker is busy stays buffered, so no wake-up is lost.
+    """
+    pubsub: redis.client.PubSub
+
+    def __init__(self, conn: redis.Redis, statuses: Iterable[MessageStatus]):
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*[notify_channel(s) for s in statuses])
+
+    def wait(self, timeout: float) -> bool:
+        woke = self.pubsub.get_message(timeout=max(timeout, 0)) is not None
+        while self.pubsub.get_message() is not None:
+            woke = True
+        return woke
+
+    def close(self):
+        self.pubsub.close()
+
+    def __enter__(self) -> 'StageNotifier':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncStageNotifier:
+    """
+    asyncio counterpart of ``StageNotifier``; the channels are subscribed on ``async with``.
+    """
+    pubsub: redis.asyncio.client.PubSub
+
+    def __init__(self, conn: redis.asyncio.Redis, statuses: Iterable[MessageStatus]):
+        self.pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        self._channels = [notify_channel(s) for s in statuses]
+
+    async def wait(self, timeout: float) -> bool:
+        woke = await self.pubsub.get_message(timeout=max(timeout, 0)) is not None
+        while await self.pubsub.get_message() is not None:
+            woke = True
+        return woke
+
+    async def close(self):
+        await self.pubsub.aclose()
+
+    async def __aenter__(self) -> 'AsyncStageNotifier':
+        await self.pubsub.subscribe(*self._channels)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -0,0 +1,57 @@
+from typing import NamedTuple, Optional, FrozenSet, Dict
+
+from lib.utils import MessageStatus
+
+REQUEUE_CHUNK = 1000
+
+# ARGV[1] is a placeholder no uid can equal, followed by (index, uid) pairs. An entry is claimed
+# only if it still holds the expected uid, so concurrent runs never requeue the same failure twice.
+CLAIM_FAILED = """
+local out = {}
+for i = 2, #ARGV, 2 do
+    if redis.call('LINDEX', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('LSET', KEYS[1], ARGV[i], ARGV[1])
+        out[#out + 1] = ARGV[i + 1]
+    end
+end
+if #out > 0 then
+    redis.call('LREM', KEYS[1], -#out, ARGV[1])
+end
+return out
+"""
+CLAIM_PLACEHOLDER = b'\x00requeue'
+
+
+class FailureInfo(NamedTuple):
+    stage: MessageStatus
+    monitor: Optional[str]
+    failed_at: Optional[float]
+    retries: int
+
+
+class RequeueFilter(NamedTuple):
+    stages: Optional[FrozenSet[MessageStatus]] = None
+    monitors: Optional[FrozenSet[str]] = None
+    min_age: Optional[float] = None
+    max_age: Optional[float] = None
+    max_retries: Optional[int] = None
+
+    def match(self, info: FailureInfo, now: float) -> bool:
+        if self.stages is not None and info.stage not in self.stages:
+            return False
+        if self.monitors is not None and info.monitor not in self.monitors:
+            return False
+        if self.max_retries is not None and info.retries > self.max_retries:
+            return False
+        # Failures recorded before failure times were kept count as older than any bound.
+        age = now - info.failed_at if info.failed_at is not None else float('inf')
+        if self.min_age is not None and age < self.min_age:
+            return False
+        if self.max_age is not None and age > self.max_age:
+            return False
+        return True
+
+
+class RequeueSummary(NamedTuple):
+    scanned: int
+    requeued: Dict[MessageStatus, int]
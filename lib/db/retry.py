@@ -0,0 +1,59 @@
+import random
+import time
+from typing import NamedTuple, List, Optional
+
+import redis
+from redis.commands.core import Script
+
+from .utils import ENCODING
+
+_CLAIM_DUE = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+class RetryBackoff(NamedTuple):
+    base_delay: float = 30
+    max_delay: float = 3600
+
+    def delay(self, attempt: int) -> float:
+        # Equal jitter: at least half of the capped exponential delay, the rest random.
+        d = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return d / 2 + random.uniform(0, d / 2)
+
+
+class DelayedQueue:
+    conn: redis.Redis
+    queue_key: str
+
+    def __init__(self, conn: redis.Redis, queue_key: str, _script: Optional[Script] = None):
+        self.conn = conn
+        self.queue_key = queue_key
+        self._script = _script or conn.register_script(_CLAIM_DUE)
+
+    def bind(self, conn: redis.Redis) -> 'DelayedQueue':
+        return DelayedQueue(conn, self.queue_key, self._script)
+
+    def schedule(self, uid: str, at: float):
+        self.conn.zadd(self.queue_key, {uid.encode(ENCODING): at})
+
+    def _claim_raw(self, limit: int, now: Optional[float] = None):
+        if now is None:
+            now = time.time()
+        return self._script(keys=[self.queue_key], args=[now, limit], client=self.conn)
+
+    def claim_due(self, limit: int, now: Optional[float] = None) -> List[str]:
+        return [b.decode(ENCODING) for b in self._claim_raw(limit, now)]
+
+    def size(self) -> int:
+        return self.conn.zcard(self.queue_key)
+
+    def list(self) -> List[str]:
+        return [
+            b.decode(ENCODING)
+            for b in self.conn.zrange(self.queue_key, 0, -1)
+        ]
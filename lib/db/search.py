@@ -0,0 +1,47 @@
+import random
+import time
+from typing import List, Tuple, Iterable
+
+import redis
+
+from lib.search import tokenize, parse_query, message_time, char_bigrams
+from lib.utils import UMessage
+from .names import search_term_key, search_author_key, search_vocab_key, search_char_key
+from .utils import ENCODING
+
+# Only the newest postings of a term or author are kept, so common terms stay bounded. Lists are
+# trimmed on about one add in TRIM_EVERY, and all of them by rebuild_search_index.py.
+MAX_POSTINGS = 10000
+TRIM_EVERY = 100
+# Intersections and one-character unions are cached this long, so paging through them is cheap.
+RESULT_TTL = 60
+
+
+def trim_postings(p: redis.client.Pipeline, key: str):
+    p.zremrangebyrank(key, 0, -(MAX_POSTINGS + 1))
+
+
+def index_message(p: redis.client.Pipeline, msg: UMessage):
+    # Posting lists are sorted sets of uids scored by message time, newest last.
+    score = message_time(msg) or time.time()
+    member = {msg.uid.encode(ENCODING): score}
+    tokens = tokenize(msg.content)
+    for k in [search_author_key(msg.author)] + [search_term_key(t) for t in tokens]:
+        p.zadd(k, member)
+        if random.randrange(TRIM_EVERY) == 0:
+            trim_postings(p, k)
+    for c, bigrams in char_bigrams(tokens).items():
+        p.sadd(search_vocab_key(c), *bigrams)
+
+
+def query_keys(query: str) -> Tuple[List[str], List[str]]:
+    # Also returns the single CJK characters, whose keys are unions of their bigrams built on demand.
+    authors, tokens = parse_query(query)
+    keys = [search_author_key(a) for a in authors] + \
+           [search_char_key(t) if len(t) == 1 else search_term_key(t) for t in tokens]
+    return keys, [t for t in tokens if len(t) == 1]
+
+
+def char_union_keys(char: str, bigrams: Iterable[bytes]) -> List[str]:
+    # A character that made up a whole run was indexed as itself.
+    return [search_term_key(char)] + [search_term_key(b.decode(ENCODING)) for b in bigrams]
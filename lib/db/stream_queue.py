@@ -0,0 +1,155 @@
+import time
+from collections import deque
+from typing import Optional, List, Iterable, Dict, Deque, Tuple, Generator, Any, TypeVar
+
+import redis
+import redis.asyncio
+
+from .utils import ENCODING
+
+STREAM_GROUP = 'stbot.workers'
+_UID_FIELD = b'u'
+_CLAIM_BATCH = 100
+
+T = TypeVar('T')
+Command = Tuple[str, tuple, dict]
+
+
+def drive(conn: redis.Redis, steps: Generator[Command, Any, T]) -> T:
+    res, err = None, None
+    while True:
+        try:
+            name, args, kwargs = steps.send(res) if err is None else steps.throw(err)
+        except StopIteration as stop:
+            return stop.value
+        res, err = None, None
+        try:
+            res = getattr(conn, name)(*args, **kwargs)
+        except redis.ResponseError as e:
+            err = e
+
+
+async def drive_async(conn: redis.asyncio.Redis, steps: Generator[Command, Any, T]) -> T:
+    res, err = None, None
+    while True:
+        try:
+            name, args, kwargs = steps.send(res) if err is None else steps.throw(err)
+        except StopIteration as stop:
+            return stop.value
+        res, err = None, None
+        try:
+            res = await getattr(conn, name)(*args, **kwargs)
+        except redis.ResponseError as e:
+            err = e
+
+
+class StreamQueue:
+    """
+    Stage queue on a Redis Stream consumer group.
+
+    Popped entries stay in this consumer's pending list until ``ack`` is called on stage
+    completion, so entries of a crashed or killed worker are reclaimed by the others with
+    XAUTOCLAIM once they have been idle for ``claim_idle_ms``.
+    """
+    conn: redis.Redis
+    queue_key: str
+    consumer: str
+    claim_idle_ms: int
+
+    def __init__(self, conn: redis.Redis, queue_key: str, consumer: str, claim_idle_ms: int,
+                 _pending: Optional[Dict[str, bytes]] = None):
+        self.conn = conn
+        self.queue_key = queue_key
+        self.consumer = consumer
+        self.claim_idle_ms = claim_idle_ms
+        self._pending = {} if _pending is None else _pending
+        self._claimed: Deque[Tuple[bytes, str]] = deque()
+        self._last_claim = 0.0
+        self._group_ready = False
+
+    def bind(self, conn: redis.Redis) -> 'StreamQueue':
+        return StreamQueue(conn, self.queue_key, self.consumer, self.claim_idle_ms, self._pending)
+
+    def _pop_steps(self, n: int) -> Generator[Command, Any, List[str]]:
+        # The claim and pop logic yields each Redis call and receives its result, so StreamQueue
+        # and AsyncUDB drive the same steps over a blocking or an asyncio connection.
+        if not self._group_ready:
+            try:
+                yield 'xgroup_create', (self.queue_key, STREAM_GROUP), dict(id='0', mkstream=True)
+            except redis.ResponseError as err:
+                if 'BUSYGROUP' not in str(err):
+                    raise
+            for c in (yield 'xinfo_consumers', (self.queue_key, STREAM_GROUP), {}):
+                name = c['name']
+                name = name.decode(ENCODING) if isinstance(name, bytes) else name
+                if c['pending'] == 0 and c['idle'] > self.claim_idle_ms and name != self.consumer:
+                    yield 'xgroup_delconsumer', (self.queue_key, STREAM_GROUP, name), {}
+            self._group_ready = True
+        now = time.time()
+        if now - self._last_claim >= self.claim_idle_ms / 1000:
+            self._last_claim = now
+            start = '0-0'
+            while True:
+                res = yield 'xautoclaim', (self.queue_key, STREAM_GROUP, self.consumer, self.claim_idle_ms), \
+                    dict(start_id=start, count=_CLAIM_BATCH)
+                start, entries = res[0], res[1]
+                for eid, fields in entries:
+                    if fields:
+                        self._claimed.append((eid, fields[_UID_FIELD].decode(ENCODING)))
+                if start in (b'0-0', '0-0') or len(self._claimed) >= _CLAIM_BATCH:
+                    break
+        entries = []
+        while self._claimed and len(entries) < n:
+            entries.append(self._claimed.popleft())
+        if len(entries) < n:
+            res = yield 'xreadgroup', (STREAM_GROUP, self.consumer, {self.queue_key: '>'}), dict(count=n - len(entries))
+            if res and res[0][1]:
+                entries.extend((eid, fields[_UID_FIELD].decode(ENCODING)) for eid, fields in res[0][1])
+        for eid, uid in entries:
+            self._pending[uid] = eid
+        return [uid for _, uid in entries]
+
+    def push(self, uid: str):
+        self.conn.xadd(self.queue_key, {_UID_FIELD: uid.encode(ENCODING)})
+
+    def pop_many(self, n: int) -> List[str]:
+        return drive(self.conn, self._pop_steps(n))
+
+    def pop(self) -> Optional[str]:
+        res = self.pop_many(1)
+        if res:
+            return res[0]
+
+    def ack(self, uid: str):
+        eid = self._pending.pop(uid, None)
+        if eid is not None:
+            self.conn.xack(self.queue_key, STREAM_GROUP, eid)
+            self.conn.xdel(self.queue_key, eid)
+
+    def push_back(self, uids: List[str]):
+        # Entries can not be put back ahead of the stream, so they are handed over as new ones.
+        for uid in uids:
+            self.ack(uid)
+            self.push(uid)
+
+    def size(self):
+        return self.conn.xlen(self.queue_key)
+
+    def empty(self) -> bool:
+        return self.size() == 0
+
+    def iter_pop(self, limit: Optional[int] = None) -> Iterable[str]:
+        if limit is None:
+            limit = -1
+        while limit != 0:
+            d = self.pop()
+            if d is None:
+                break
+            yield d
+            limit -= 1
+
+    def list(self) -> List[str]:
+        return [
+            fields[_UID_FIELD].decode(ENCODING)
+            for _, fields in self.conn.xrange(self.queue_key)
+        ]
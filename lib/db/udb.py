@@ -1,36 +1,97 @@
+import socket
+import time
+from collections import Counter
+from contextlib import contextmanager
 from functools import reduce
 from operator import or_
-from typing import AnyStr, Optional, Iterable, List, Callable, Any, Dict
+from typing import AnyStr, Optional, Iterable, List, Callable, Any, Dict, Iterator, Union, Tuple
 
 import redis
+from redis.cluster import ClusterNode, RedisCluster
 
-from lib.config import RedisConfig
+from lib.config import RedisConfig, CrawlerConfig
+from lib.phash import HASH_BYTES
+from lib.profiling import ProfiledRedis, ProfiledRedisCluster, enabled as profiling_enabled
 from lib.utils import UMessage, MessageStatus
+from .events import LifecycleEvent, append_event, read_events, default_worker, error_class
+from .fair_queue import FairQueue
+from .image_hashes import HASH_LOG_COUNT, HASH_LOG_RANGE, HASH_LOG_TRIM
 from .names import *
+from .notify import StageNotifier
+from .requeue import CLAIM_FAILED, CLAIM_PLACEHOLDER, REQUEUE_CHUNK, FailureInfo, RequeueFilter, RequeueSummary
+from .retry import RetryBackoff, DelayedQueue
+from .search import index_message, query_keys, char_union_keys, RESULT_TTL
+from .stream_queue import StreamQueue
 from .utils import ENCODING, RBQueue
 from .versions import initialize
 
 
 def connect_db(config: RedisConfig) -> redis.Redis:
-    return redis.StrictRedis(host=config.host, port=config.port, db=config.db)
+    configure_layout(bool(config.cluster_nodes), config.hash_shards)
+    profiled = profiling_enabled()
+    if config.cluster_nodes:
+        return (ProfiledRedisCluster if profiled else RedisCluster)(startup_nodes=[
+            ClusterNode(host, int(port))
+            for host, port in (n.rsplit(':', 1) for n in config.cluster_nodes)
+        ])
+    return (ProfiledRedis if profiled else redis.StrictRedis)(host=config.host, port=config.port, db=config.db)
+
+
+StageQueue = Union[RBQueue, StreamQueue, FairQueue]
+
+
+def _stage_queue(conn: redis.Redis, config: RedisConfig, list_key: str, stream_key: str,
+                 fair_key: Optional[str] = None) -> StageQueue:
+    if config.queue_backend == 'list':
+        return RBQueue(conn, list_key)
+    elif config.queue_backend == 'fair':
+        if config.cluster_nodes:
+            # The fair queue scripts touch keys they do not declare, which a cluster can not route.
+            raise ValueError("The fair queue backend is not supported in cluster mode")
+        if fair_key is None:
+            return RBQueue(conn, list_key)
+        return FairQueue(conn, fair_key, MONITOR_WEIGHT)
+    elif config.queue_backend == 'stream':
+        consumer = config.consumer or socket.gethostname()
+        return StreamQueue(conn, stream_key, consumer, config.claim_idle_ms)
+    raise ValueError(f"Unknown queue backend: {config.queue_backend}")
+
+
+def _batch_limit(q: StageQueue, batch_size: int) -> int:
+    # A popped stream entry idles toward claim_idle_ms, after which another consumer takes it over,
+    # so stream entries are popped one per item handed out rather than held behind a batch.
+    if isinstance(q, StreamQueue):
+        return 1
+    return batch_size
 
 
 class UDB:
     version = '0'
     conn: redis.Redis
-    download_queue: RBQueue
-    post_queue: RBQueue
-    success_queue: RBQueue
+    download_queue: StageQueue
+    post_queue: StageQueue
+    success_queue: StageQueue
     cleaned_queue: RBQueue
     failed_queue: RBQueue
-    _status_to_queue: Dict[MessageStatus, RBQueue]
+    worker: str
+    backoff: RetryBackoff
+    poll_batch_size: int
+    _status_to_queue: Dict[MessageStatus, StageQueue]
+    _delayed: Dict[MessageStatus, DelayedQueue]
 
-    def __init__(self, config: RedisConfig):
+    def __init__(self, config: RedisConfig, worker: Optional[str] = None, crawler: Optional[CrawlerConfig] = None):
         self.conn = connect_db(config)
+        self.cluster = bool(config.cluster_nodes)
+        self.poll_batch_size = config.poll_batch_size
+        self.worker = worker or default_worker()
+        if crawler is None:
+            self.backoff = RetryBackoff()
+        else:
+            self.backoff = RetryBackoff(crawler.retry_base_delay, crawler.retry_max_delay)
         initialize(self.conn)
-        self.download_queue = RBQueue(self.conn, DOWNLOAD_QUEUE)
-        self.post_queue = RBQueue(self.conn, POST_QUEUE)
-        self.success_queue = RBQueue(self.conn, SUCCESS_QUEUE)
+        self.download_queue = _stage_queue(self.conn, config, DOWNLOAD_QUEUE, DOWNLOAD_STREAM, DOWNLOAD_FAIR_QUEUE)
+        self.post_queue = _stage_queue(self.conn, config, POST_QUEUE, POST_STREAM, POST_FAIR_QUEUE)
+        self.success_queue = _stage_queue(self.conn, config, SUCCESS_QUEUE, SUCCESS_STREAM)
         self.cleaned_queue = RBQueue(self.conn, CLEANED_QUEUE)
         self.failed_queue = RBQueue(self.conn, FAILED_QUEUE)
         self._status_to_queue = {
@@ -40,55 +101,220 @@ class UDB:
             MessageStatus.Success: self.success_queue,
             MessageStatus.Cleaned: self.cleaned_queue
         }
+        for q in self._status_to_queue.values():
+            if isinstance(q, FairQueue):
+                q.load()
+        self._delayed = {
+            s: DelayedQueue(self.conn, delayed_retry_key(s))
+            for s in (MessageStatus.Downloading, MessageStatus.Posting, MessageStatus.Success)
+        }
+        self._claim_failed = self.conn.register_script(CLAIM_FAILED)
+        self._hash_log_count = self.conn.register_script(HASH_LOG_COUNT)
+        self._hash_log_range = self.conn.register_script(HASH_LOG_RANGE)
+        self._hash_log_trim = self.conn.register_script(HASH_LOG_TRIM)
+
+    def _multi(self) -> redis.client.Pipeline:
+        # A message's keys and the queue keys live in different slots of a cluster, so transitions
+        # there are plain pipelines and recover() repairs any that were cut short.
+        return self.conn.pipeline(transaction=not self.cluster)
+
+    @contextmanager
+    def _transition(self, uid: AnyStr, stage: str, status: MessageStatus,
+                    error: Optional[BaseException] = None) -> Iterator[redis.client.Pipeline]:
+        p = self._multi()
+        yield p
+        append_event(p, uid, stage, status, self.worker, error_class(error))
+        p.publish(notify_channel(status), uid)
+        p.execute()
 
     def download_add(self, data: UMessage):
-        self.put_data(data)
-        self.set_status(data.uid, MessageStatus.Downloading)
-        self.download_queue.push(data.uid)
+        with self._transition(data.uid, 'download_add', MessageStatus.Downloading) as p:
+            p[data_key(data.uid)] = data.stringify().encode(ENCODING)
+            p[status_key(data.uid)] = MessageStatus.Downloading.value.encode(ENCODING)
+            self.download_queue.bind(p).push(data.uid)
+            index_message(p, data)
+
+    def download_add_many(self, msgs: Iterable[UMessage]) -> List[UMessage]:
+        # Uids that already exist are skipped; the rest of the batch is written in one transaction,
+        # retried if another ingester stores one of its uids in between.
+        batch = list({m.uid: m for m in msgs}.values())
+        if not batch:
+            return []
+        if self.cluster:
+            return self._cluster_download_add_many(batch)
+        with self.conn.pipeline() as p:
+            while True:
+                try:
+                    p.watch(*[data_key(m.uid) for m in batch])
+                    exists = self.data_exists_many(m.uid for m in batch)
+                    new = [m for m, e in zip(batch, exists) if not e]
+                    if not new:
+                        return []
+                    p.multi()
+                    for m in new:
+                        p[data_key(m.uid)] = m.stringify().encode(ENCODING)
+                    self._enqueue_new(p, new)
+                    p.execute()
+                    return new
+                except redis.WatchError:
+                    continue
+
+    def _cluster_download_add_many(self, batch: List[UMessage]) -> List[UMessage]:
+        # WATCH can not span slots, so each uid is claimed by creating its data key. As with other
+        # cluster transitions, a crash before the second pipeline leaves the claimed ones unqueued.
+        p = self._multi()
+        for m in batch:
+            p.set(data_key(m.uid), m.stringify().encode(ENCODING), nx=True)
+        new = [m for m, ok in zip(batch, p.execute()) if ok]
+        if new:
+            with self._multi() as p:
+                self._enqueue_new(p, new)
+                p.execute()
+        return new
+
+    def _enqueue_new(self, p: redis.client.Pipeline, new: List[UMessage]):
+        q = self.download_queue.bind(p)
+        for m in new:
+            p[status_key(m.uid)] = MessageStatus.Downloading.value.encode(ENCODING)
+            q.push(m.uid)
+            index_message(p, m)
+            append_event(p, m.uid, 'download_add', MessageStatus.Downloading, self.worker, None)
+        p.publish(notify_channel(MessageStatus.Downloading), len(new))
+
+    def _schedule_retry(self, p: redis.client.Pipeline, uid: AnyStr, status: MessageStatus):
+        at = time.time() + self.backoff.delay(self.get_retry(uid))
+        self._delayed[status].bind(p).schedule(uid, at)
+        p.incr(retry_count_key(uid))
+
+    def promote_retries(self, status: MessageStatus, limit: int = 1000) -> int:
+        due = self._delayed[status].claim_due(limit)
+        if due:
+            with self._multi() as p:
+                q = self._status_to_queue[status].bind(p)
+                for uid in due:
+                    q.push(uid)
+                p.publish(notify_channel(status), len(due))
+                p.execute()
+        return len(due)
+
+    def _iter_batches(self, q: StageQueue, limit: Optional[int], batch_size: Optional[int]) -> Iterator[UMessage]:
+        # One counted pop and one MGET per batch; smaller batches hold fewer popped items in memory
+        # and hand the first one out sooner.
+        batch_size = _batch_limit(q, batch_size or self.poll_batch_size)
+        remaining = -1 if limit is None else limit
+        while remaining != 0:
+            n = batch_size if remaining < 0 else min(batch_size, remaining)
+            uids = q.pop_many(n)
+            for uid, m in zip(uids, self.get_data_many(uids)):
+                if m is not None:
+                    yield m
+                else:
+                    # Nothing to process without its data, so the entry is dropped rather than left pending.
+                    q.ack(uid)
+            if len(uids) < n:
+                break
+            if remaining > 0:
+                remaining -= n
+
+    def next_retry_in(self, status: MessageStatus) -> Optional[float]:
+        res = self.conn.zrange(delayed_retry_key(status), 0, 0, withscores=True)
+        if res:
+            return max(res[0][1] - time.time(), 0)
+
+    def subscribe(self, *statuses: MessageStatus) -> StageNotifier:
+        return StageNotifier(self.conn, statuses)
+
+    def retry_count(self) -> int:
+        return sum(d.size() for d in self._delayed.values())
+
+    def iter_poll(self, status: MessageStatus, limit: Optional[int] = None,
+                  batch_size: Optional[int] = None) -> Iterator[UMessage]:
+        self.promote_retries(status)
+        return self._iter_batches(self._status_to_queue[status], limit, batch_size)
+
+    def poll_batch_limit(self, status: MessageStatus) -> int:
+        return _batch_limit(self._status_to_queue[status], self.poll_batch_size)
+
+    def push_back(self, status: MessageStatus, uids: List[str]):
+        # For uids popped from the stage queue but not finished. Ones that moved to another status
+        # or wait for a delayed retry meanwhile are already queued elsewhere and are left alone.
+        if not uids:
+            return
+        p = self.conn.pipeline(transaction=False)
+        for uid in uids:
+            p.get(status_key(uid))
+            p.zscore(delayed_retry_key(status), uid)
+        res = p.execute()
+        current = status.value.encode(ENCODING)
+        uids = [uid for uid, s, delayed in zip(uids, res[::2], res[1::2]) if s == current and delayed is None]
+        if not uids:
+            return
+        with self._multi() as p:
+            self._status_to_queue[status].bind(p).push_back(uids)
+            p.execute()
+
+    def stage_cost_get(self, status: MessageStatus) -> Optional[float]:
+        c = self.conn.get(stage_cost_key(status))
+        if c is not None:
+            return float(c)
+
+    def stage_cost_set(self, status: MessageStatus, seconds: float):
+        self.conn[stage_cost_key(status)] = str(seconds).encode(ENCODING)
 
     def download_poll(self) -> Optional[UMessage]:
+        self.promote_retries(MessageStatus.Downloading)
         uid = self.download_queue.pop()
         if uid is not None:
             return self.get_data(uid)
 
-    def download_iter_poll(self, limit: Optional[int] = None) -> Iterable[UMessage]:
-        return map(self.get_data, self.download_queue.iter_pop(limit))
+    def download_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> Iterator[UMessage]:
+        self.promote_retries(MessageStatus.Downloading)
+        return self._iter_batches(self.download_queue, limit, batch_size)
 
     def download_count(self) -> int:
         return self.download_queue.size()
 
-    def download_retry(self, uid: AnyStr):
-        self.set_status(uid, MessageStatus.Downloading)
-        self.download_queue.push(uid)
-        self.inc_retry(uid)
+    def download_retry(self, uid: AnyStr, error: Optional[BaseException] = None):
+        with self._transition(uid, 'download_retry', MessageStatus.Downloading, error) as p:
+            p[status_key(uid)] = MessageStatus.Downloading.value.encode(ENCODING)
+            self.download_queue.bind(p).ack(uid)
+            self._schedule_retry(p, uid, MessageStatus.Downloading)
 
     def post_add(self, uid: AnyStr):
         self.assert_status(uid, MessageStatus.Downloading)
-        self.set_status(uid, MessageStatus.Posting)
-        self.post_queue.push(uid)
+        with self._transition(uid, 'post_add', MessageStatus.Posting) as p:
+            p[status_key(uid)] = MessageStatus.Posting.value.encode(ENCODING)
+            self.download_queue.bind(p).ack(uid)
+            self.post_queue.bind(p).push(uid)
 
     def post_poll(self) -> Optional[UMessage]:
+        self.promote_retries(MessageStatus.Posting)
         uid = self.post_queue.pop()
         if uid is not None:
             return self.get_data(uid)
 
-    def post_iter_poll(self, limit: Optional[int] = None) -> Iterable[UMessage]:
-        return map(self.get_data, self.post_queue.iter_pop(limit))
+    def post_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> Iterator[UMessage]:
+        self.promote_retries(MessageStatus.Posting)
+        return self._iter_batches(self.post_queue, limit, batch_size)
 
     def post_count(self):
         return self.post_queue.size()
 
-    def post_retry(self, uid: AnyStr):
+    def post_retry(self, uid: AnyStr, error: Optional[BaseException] = None):
         self.assert_status(uid, MessageStatus.Posting)
-        self.post_queue.push(uid)
-        self.inc_retry(uid)
+        with self._transition(uid, 'post_retry', MessageStatus.Posting, error) as p:
+            self.post_queue.bind(p).ack(uid)
+            self._schedule_retry(p, uid, MessageStatus.Posting)
 
     def add_success(self, uid: AnyStr):
         self.assert_status(uid, MessageStatus.Posting)
-        self.set_status(uid, MessageStatus.Success)
-        self.success_queue.push(uid)
+        with self._transition(uid, 'add_success', MessageStatus.Success) as p:
+            p[status_key(uid)] = MessageStatus.Success.value.encode(ENCODING)
+            self.post_queue.bind(p).ack(uid)
+            self.success_queue.bind(p).push(uid)
 
     def success_poll(self) -> Optional[UMessage]:
+        self.promote_retries(MessageStatus.Success)
         uid = self.success_queue.pop()
         if uid is not None:
             return self.get_data(uid)
@@ -96,27 +322,34 @@ class UDB:
     def success_count(self):
         return self.success_queue.size()
 
-    def success_iter_poll(self, limit: Optional[int] = None) -> Iterable[UMessage]:
-        return map(self.get_data, self.success_queue.iter_pop(limit))
+    def success_iter_poll(self, limit: Optional[int] = None, batch_size: Optional[int] = None) -> Iterator[UMessage]:
+        self.promote_retries(MessageStatus.Success)
+        return self._iter_batches(self.success_queue, limit, batch_size)
 
     def clean(self, uid: AnyStr):
         self.assert_status(uid, MessageStatus.Success)
-        self.set_status(uid, MessageStatus.Cleaned)
-        self.cleaned_queue.push(uid)
+        with self._transition(uid, 'clean', MessageStatus.Cleaned) as p:
+            p[status_key(uid)] = MessageStatus.Cleaned.value.encode(ENCODING)
+            self.success_queue.bind(p).ack(uid)
+            self.cleaned_queue.bind(p).push(uid)
 
     def clean_count(self):
         return self.cleaned_queue.size()
 
-    def clean_retry(self, uid: str):
-        self.set_status(uid, MessageStatus.Success)
-        self.success_queue.push(uid)
-        self.inc_retry(uid)
+    def clean_retry(self, uid: str, error: Optional[BaseException] = None):
+        with self._transition(uid, 'clean_retry', MessageStatus.Success, error) as p:
+            p[status_key(uid)] = MessageStatus.Success.value.encode(ENCODING)
+            self.success_queue.bind(p).ack(uid)
+            self._schedule_retry(p, uid, MessageStatus.Success)
 
-    def fail(self, uid: AnyStr):
+    def fail(self, uid: AnyStr, error: Optional[BaseException] = None):
         current_status = self.get_status(uid)
-        self.set_status(uid, MessageStatus.Failed)
-        self.failed_queue.push(uid)
-        self.set_failure_status(uid, current_status)
+        with self._transition(uid, 'fail', MessageStatus.Failed, error) as p:
+            p[status_key(uid)] = MessageStatus.Failed.value.encode(ENCODING)
+            self._status_to_queue[current_status].bind(p).ack(uid)
+            self.failed_queue.bind(p).push(uid)
+            p[get_failure_status(uid)] = current_status.value.encode(ENCODING)
+            p[failure_time_key(uid)] = str(time.time()).encode(ENCODING)
 
     def set_failure_status(self, uid: AnyStr, status: MessageStatus):
         self.conn[get_failure_status(uid)] = status.value.encode(ENCODING)
@@ -140,12 +373,81 @@ class UDB:
         d = self.conn[data_key(uid)]
         return UMessage.parse(d.decode(ENCODING))
 
+    def get_data_many(self, uids: Iterable[AnyStr]) -> List[Optional[UMessage]]:
+        uids = list(uids)
+        if not uids:
+            return []
+        return [
+            UMessage.parse(d.decode(ENCODING)) if d is not None else None
+            for d in (self.conn.mget_nonatomic if self.cluster else self.conn.mget)([data_key(u) for u in uids])
+        ]
+
     def data_exists(self, uid: AnyStr) -> bool:
         return data_key(uid) in self.conn
 
+    def data_exists_many(self, uids: Iterable[AnyStr]) -> List[bool]:
+        with self.conn.pipeline(transaction=False) as p:
+            for u in uids:
+                p.exists(data_key(u))
+            return [r == 1 for r in p.execute()]
+
+    def _expand_chars(self, chars: List[str]):
+        # A one-character CJK query matches every indexed bigram holding the character.
+        if not chars:
+            return
+        p = self.conn.pipeline(transaction=False)
+        for c in chars:
+            p.exists(search_char_key(c))
+            p.smembers(search_vocab_key(c))
+        res = p.execute()
+        with self._multi() as p:
+            for c, cached, bigrams in zip(chars, res[::2], res[1::2]):
+                if not cached:
+                    p.zunionstore(search_char_key(c), char_union_keys(c, bigrams), aggregate='MAX')
+                    p.expire(search_char_key(c), RESULT_TTL)
+            p.execute()
+
+    def search(self, query: str, offset: int = 0, limit: int = 10) -> Tuple[int, List[UMessage]]:
+        keys, chars = query_keys(query)
+        if not keys:
+            return 0, []
+        self._expand_chars(chars)
+        with self._multi() as p:
+            if len(keys) == 1:
+                k = keys[0]
+            else:
+                # Paging through the same query reuses the intersection for RESULT_TTL.
+                k = search_result_key(keys)
+                p.exists(k)
+            p.zcard(k)
+            p.zrevrange(k, offset, offset + limit - 1)
+            res = p.execute()
+        total, uids = res[-2], res[-1]
+        if len(keys) > 1 and not res[0]:
+            with self._multi() as p:
+                p.zinterstore(k, keys, aggregate='MAX')
+                p.expire(k, RESULT_TTL)
+                p.zrevrange(k, offset, offset + limit - 1)
+                total, _, uids = p.execute()
+        return total, [m for m in self.get_data_many(u.decode(ENCODING) for u in uids) if m is not None]
+
+    def search_index_add_many(self, msgs: Iterable[UMessage]):
+        with self.conn.pipeline(transaction=False) as p:
+            for m in msgs:
+                index_message(p, m)
+            p.execute()
+
     def monitor_add(self, type_: MessageType, name: str):
-        k = monitor_key(type_)
-        self.conn.sadd(k, name.encode(ENCODING))
+        self.monitor_add_many(type_, [name])
+
+    def monitor_add_many(self, type_: MessageType, names: Iterable[str]):
+        names = [n.encode(ENCODING) for n in names]
+        if not names:
+            return
+        with self._multi() as p:
+            p.sadd(monitor_key(type_), *names)
+            p.zadd(monitor_index_key(type_), dict.fromkeys(names, 0))
+            p.execute()
 
     def monitor_list(self, type_: MessageType) -> List[str]:
         k = monitor_key(type_)
@@ -155,19 +457,122 @@ class UDB:
         ]
 
     def monitor_remove(self, type_: MessageType, name: str):
+        self.monitor_remove_many(type_, [name])
+
+    def monitor_remove_many(self, type_: MessageType, names: Iterable[str]):
+        names = [n.encode(ENCODING) for n in names]
+        if not names:
+            return
+        with self._multi() as p:
+            p.srem(monitor_key(type_), *names)
+            p.zrem(monitor_index_key(type_), *names)
+            p.execute()
+
+    def monitor_count(self, type_: MessageType) -> int:
+        return self.conn.scard(monitor_key(type_))
+
+    def monitor_page(self, type_: MessageType, prefix: str = '', after: Optional[str] = None,
+                     limit: int = 100) -> List[str]:
+        # All members of the index share score 0, so it is ordered lexicographically and a page
+        # is resumed from the last name of the previous one.
+        p = prefix.encode(ENCODING)
+        lo = b'(' + after.encode(ENCODING) if after is not None and after >= prefix else b'[' + p
+        hi = b'[' + p + b'\xff' if p else b'+'
+        return [
+            s.decode(ENCODING)
+            for s in self.conn.zrangebylex(monitor_index_key(type_), lo, hi, start=0, num=limit)
+        ]
+
+    def monitor_reindex(self, type_: MessageType, chunk_size: int = 1000):
         k = monitor_key(type_)
-        self.conn.srem(k, name.encode(ENCODING))
+        ik = monitor_index_key(type_)
+        if self.conn.scard(k) == self.conn.zcard(ik):
+            return
+        self.conn.delete(ik)
+        chunk = []
+        for name in self.conn.sscan_iter(k, count=chunk_size):
+            chunk.append(name)
+            if len(chunk) >= chunk_size:
+                self.conn.zadd(ik, dict.fromkeys(chunk, 0))
+                chunk = []
+        if chunk:
+            self.conn.zadd(ik, dict.fromkeys(chunk, 0))
+
+    def since_id_get(self, type_: MessageType) -> Optional[int]:
+        d = self.conn.get(since_id_key(type_))
+        if d is not None:
+            return int(d)
+
+    def since_id_set(self, type_: MessageType, id_: int):
+        self.conn.set(since_id_key(type_), str(id_).encode(ENCODING))
+
+    def queue_counts(self) -> Dict[str, int]:
+        with self.conn.pipeline(transaction=False) as p:
+            for q in (self.download_queue, self.post_queue, self.success_queue):
+                if isinstance(q, FairQueue):
+                    p.get(q.size_key)
+                elif isinstance(q, StreamQueue):
+                    p.xlen(q.queue_key)
+                else:
+                    p.llen(q.queue_key)
+            p.llen(self.cleaned_queue.queue_key)
+            p.llen(self.failed_queue.queue_key)
+            for d in self._delayed.values():
+                p.zcard(d.queue_key)
+            res = [int(r or 0) for r in p.execute()]
+        return dict(
+            download=res[0],
+            post=res[1],
+            success=res[2],
+            cleaned=res[3],
+            failed=res[4],
+            retrying=sum(res[5:])
+        )
+
+    def monitor_weight_set(self, type_: MessageType, name: str, weight: float):
+        field = monitor_weight_field(type_, name).encode(ENCODING)
+        if weight == 1:
+            self.conn.hdel(MONITOR_WEIGHT, field)
+        else:
+            self.conn.hset(MONITOR_WEIGHT, field, str(weight).encode(ENCODING))
+
+    def monitor_weights(self, type_: MessageType) -> Dict[str, float]:
+        prefix = monitor_weight_field(type_, '')
+        return {
+            k.decode(ENCODING)[len(prefix):]: float(v.decode(ENCODING))
+            for k, v in self.conn.hgetall(MONITOR_WEIGHT).items()
+            if k.decode(ENCODING).startswith(prefix)
+        }
 
     def add_file(self, url: str, path: str):
-        self.conn.hset(URL_TO_FILE, url.encode(ENCODING), str(path).encode(ENCODING))
+        self.conn.hset(url_to_file_key(url), url.encode(ENCODING), str(path).encode(ENCODING))
 
     def get_file(self, url: str) -> Optional[str]:
-        d = self.conn.hget(URL_TO_FILE, url.encode(ENCODING))
+        d = self.conn.hget(url_to_file_key(url), url.encode(ENCODING))
         if d is not None:
             return d.decode(ENCODING)
 
     def remove_file(self, url: str):
-        self.conn.hdel(URL_TO_FILE, url.encode(ENCODING))
+        self.conn.hdel(url_to_file_key(url), url.encode(ENCODING))
+
+    def image_hash_add(self, uid: str, hashes: Iterable[bytes]):
+        # Log of hash + uid records; the on-disk image index is built from its head, which is then trimmed.
+        records = [h + uid.encode(ENCODING) for h in hashes]
+        if records:
+            self.conn.rpush(IMAGE_HASH_LOG, *records)
+
+    def image_hash_count(self) -> int:
+        return self._hash_log_count(keys=[IMAGE_HASH_LOG, IMAGE_HASH_OFFSET])
+
+    def image_hash_range(self, start: int, end: int = -1) -> List[Tuple[bytes, str]]:
+        # Positions count every record ever logged; records before the trimmed head are not returned.
+        return [
+            (r[:HASH_BYTES], r[HASH_BYTES:].decode(ENCODING))
+            for r in self._hash_log_range(keys=[IMAGE_HASH_LOG, IMAGE_HASH_OFFSET], args=[start, end])
+        ]
+
+    def image_hash_trim(self, upto: int) -> int:
+        return self._hash_log_trim(keys=[IMAGE_HASH_LOG, IMAGE_HASH_OFFSET], args=[upto])
 
     def inc_retry(self, uid: AnyStr):
         k = retry_count_key(uid)
@@ -175,11 +580,12 @@ class UDB:
         c = int(c.decode(ENCODING))
         self.conn[k] = c + 1
 
-    def retry_or_fail(self, uid: AnyStr, retry_func: Callable[[AnyStr], Any], limit: int):
+    def retry_or_fail(self, uid: AnyStr, retry_func: Callable[[AnyStr, Optional[BaseException]], Any], limit: int,
+                      error: Optional[BaseException] = None):
         if self.get_retry(uid) < limit:
-            retry_func(uid)
+            retry_func(uid, error)
         else:
-            self.fail(uid)
+            self.fail(uid, error)
 
     def get_retry(self, uid: AnyStr) -> int:
         k = retry_count_key(uid)
@@ -199,45 +605,119 @@ class UDB:
 
     def recover(self):
         error_keys = set(get_uid_from_key(k.decode(ENCODING)) for k in self.conn.keys(status_key("*"))) - \
-                     reduce(or_, (set(x.list()) for x in self._status_to_queue.values()))
+                     reduce(or_, (set(x.list()) for x in self._status_to_queue.values())) - \
+                     reduce(or_, (set(x.list()) for x in self._delayed.values()))
         for k in error_keys:
             s = self.get_status(k)
             print(k, ">>>", s.value)
-            self._status_to_queue[s].push(k)
-
-    def restart_failed_tasks(self):
-        for uid in self.failed_queue.iter_pop():
-            old_status = self.get_failure_status(uid)
-            self.clean_retry(uid)
-            self._status_to_queue[old_status].push(uid)
-            self.set_status(uid, old_status)
+            with self._transition(k, 'recover', s) as p:
+                self._status_to_queue[s].bind(p).push(k)
+
+    def _read_failures(self, uids: List[str], with_data: bool) -> List[Optional[FailureInfo]]:
+        p = self.conn.pipeline(transaction=False)
+        for uid in uids:
+            p.get(status_key(uid))
+            p.get(get_failure_status(uid))
+            p.get(failure_time_key(uid))
+            p.get(retry_count_key(uid))
+            if with_data:
+                p.get(data_key(uid))
+        res = p.execute()
+        step = 5 if with_data else 4
+        out = []
+        for uid, i in zip(uids, range(0, len(res), step)):
+            status, stage, failed_at, retries = res[i:i + 4]
+            if status != MessageStatus.Failed.value.encode(ENCODING) or stage is None:
+                out.append(None)
+                continue
+            data = res[i + 4] if with_data else None
+            out.append(FailureInfo(
+                stage=MessageStatus(stage.decode(ENCODING)),
+                monitor=UMessage.parse(data.decode(ENCODING)).monitor if data is not None else None,
+                failed_at=float(failed_at) if failed_at is not None else None,
+                retries=int(retries or 0)
+            ))
+        return out
+
+    def requeue_failed(self, f: RequeueFilter = RequeueFilter(), dry_run: bool = False,
+                       chunk_size: int = REQUEUE_CHUNK) -> RequeueSummary:
+        # The failed list is walked from its oldest end in chunks. New failures are pushed on the other
+        # end, so an entry's negative index stays put until this run claims it or steps past it.
+        # Claiming a chunk and requeueing it are two round trips, since no one script can push to every
+        # queue backend; tasks of a run cut short in between stay Failed in no queue until recover().
+        now = time.time()
+        total = self.failed_queue.size()
+        requeued = Counter()
+        scanned = kept = 0
+        while scanned < total:
+            end = -kept - 1
+            uids = [b.decode(ENCODING) for b in self.conn.lrange(FAILED_QUEUE, end - chunk_size + 1, end)]
+            if not uids:
+                break
+            uids = uids[-(total - scanned):]
+            scanned += len(uids)
+            first = end - len(uids) + 1
+            picked = {
+                uid: (first + i, t.stage)
+                for i, (uid, t) in enumerate(zip(uids, self._read_failures(uids, f.monitors is not None)))
+                if t is not None and f.match(t, now)
+            }
+            if dry_run:
+                requeued.update(stage for _, stage in picked.values())
+                kept += len(uids)
+                continue
+            claimed = []
+            if picked:
+                args = [CLAIM_PLACEHOLDER]
+                for uid, (index, _) in picked.items():
+                    args += [index, uid]
+                claimed = [b.decode(ENCODING) for b in self._claim_failed(keys=[FAILED_QUEUE], args=args)]
+            kept += len(uids) - len(claimed)
+            if claimed:
+                stages = {uid: picked[uid][1] for uid in claimed}
+                self._requeue(claimed, stages)
+                requeued.update(stages.values())
+        return RequeueSummary(scanned, dict(requeued))
+
+    def _requeue(self, uids: List[str], stages: Dict[str, MessageStatus]):
+        with self._multi() as p:
+            for uid in uids:
+                stage = stages[uid]
+                p[status_key(uid)] = stage.value.encode(ENCODING)
+                self._status_to_queue[stage].bind(p).push(uid)
+                p.delete(get_failure_status(uid), failure_time_key(uid), retry_count_key(uid))
+                append_event(p, uid, 'requeue', stage, self.worker, None)
+            for stage, n in Counter(stages.values()).items():
+                p.publish(notify_channel(stage), n)
+            p.execute()
+
+    def events(self, uid: AnyStr, count: Optional[int] = None) -> List[LifecycleEvent]:
+        return read_events(self.conn, uid, count)
 
     def relation_add(self, type_: MessageType, src: str, dst: str, status_id: str) -> int:
-        name = relation_key(type_)
         key = merge_rel_key(src, dst)
-        s = self.conn.hget(name, key) or b'0'
-        c = int(s.decode(ENCODING))
-        id_name = relation_id_key(type_)
-        bid = status_id.encode(ENCODING)
-        if not self.conn.sismember(id_name, bid):
-            self.conn.sadd(id_name, bid)
-            c += 1
-            s = str(c).encode(ENCODING)
-            self.conn.hset(name, key, s)
-        return c
+        name = relation_key(type_, key)
+        with self.conn.pipeline(transaction=False) as p:
+            p.sadd(relation_id_key(type_, status_id), status_id.encode(ENCODING))
+            p.hget(name, key)
+            added, c = p.execute()
+        # SADD reports whether the status id is new, which is what the count is bumped on.
+        if added:
+            return self.conn.hincrby(name, key, 1)
+        return int(c or 0)
 
     def relation_query(self, type_: MessageType) -> Dict[Tuple[str, str], int]:
-        name = relation_key(type_)
         return {
             split_rel_key(k.decode(ENCODING)): int(v.decode(ENCODING))
+            for name in relation_keys(type_)
             for k, v in self.conn.hscan_iter(name)
         }
 
     def reversed_index_add(self, type_: TargetType, tid, uid):
-        self.conn.hset(reversed_index_key(type_), tid.encode(ENCODING), uid.encode(ENCODING))
+        self.conn.hset(reversed_index_key(type_, tid), tid.encode(ENCODING), uid.encode(ENCODING))
 
     def reversed_index_get(self, type_: TargetType, tid) -> Optional[UMessage]:
-        uid = self.conn.hget(reversed_index_key(type_), tid.encode(ENCODING))
+        uid = self.conn.hget(reversed_index_key(type_, tid), tid.encode(ENCODING))
         if uid is None:
             return None
         uid = uid.decode(ENCODING)
@@ -9,14 +9,28 @@ class RBQueue(NamedTuple):
     conn: redis.Redis
     queue_key: str
 
+    def bind(self, conn: redis.Redis) -> 'RBQueue':
+        return self._replace(conn=conn)
+
     def push(self, uid: str):
         self.conn.lpush(self.queue_key, uid.encode(ENCODING))
 
+    def ack(self, uid: str):
+        pass
+
     def pop(self) -> Optional[str]:
         res = self.conn.rpop(self.queue_key)
         if res is not None:
             return res.decode(ENCODING)
 
+    def pop_many(self, n: int) -> List[str]:
+        # RPOP with a count needs Redis 6.2 or later.
+        return [b.decode(ENCODING) for b in self.conn.rpop(self.queue_key, n) or []]
+
+    def push_back(self, uids: List[str]):
+        # Back onto the popping end, in the order they were popped.
+        self.conn.rpush(self.queue_key, *[u.encode(ENCODING) for u in reversed(uids)])
+
     def size(self):
         return self.conn.llen(self.queue_key)
 
@@ -26,10 +40,11 @@ class RBQueue(NamedTuple):
     def iter_pop(self, limit: Optional[int] = None) -> Iterable[str]:
         if limit is None:
             limit = -1
-        d = self.pop()
-        while d is not None and limit != 0:
-            yield d
+        while limit != 0:
             d = self.pop()
+            if d is None:
+                break
+            yield d
             limit -= 1
 
     def list(self) -> List[str]:
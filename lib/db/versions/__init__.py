@@ -1,4 +1,4 @@
-from typing import Tuple, Callable, Any, Dict
+from typing import Tuple, Dict, Optional
 
 import redis
 
@@ -6,20 +6,27 @@ from ..utils import ENCODING
 from ..names import VERSION
 
 from . import migrate_0_to_0_1
+from .chunked import ChunkedMigration, Checkpoint, run_chunked, read_checkpoint, parse_checkpoint
 
-migrations: Dict[Tuple[str, str], Callable[[redis.Redis], Any]] = {
-    ('0', '0.1'): migrate_0_to_0_1.migrate
+migrations: Dict[Tuple[str, str], ChunkedMigration] = {
+    ('0', '0.1'): migrate_0_to_0_1.migration
 }
 
-CURRENT_VERSION = '0'
+CURRENT_VERSION = '0.1'
 
 
-def initialize(conn: redis.Redis):
-    v = conn.get(VERSION)
-    if v is not None and v.decode(ENCODING) != CURRENT_VERSION:
+def check_version(v: Optional[str], checkpoint: Optional[Checkpoint]):
+    # Workers of the target version may run while a migration to it is still in progress.
+    if v is not None and v != CURRENT_VERSION and (checkpoint is None or checkpoint.done):
         raise ValueError(f"Database versions not match: expected {CURRENT_VERSION}, got {v}")
 
 
+def initialize(conn: redis.Redis):
+    v = get_db_version(conn)
+    if v is not None and v != CURRENT_VERSION:
+        check_version(v, read_checkpoint(conn, v, CURRENT_VERSION))
+
+
 def get_db_version(conn: redis.Redis):
     v = conn.get(VERSION)
     if v is None:
@@ -28,11 +35,11 @@ def get_db_version(conn: redis.Redis):
         return v.decode(ENCODING)
 
 
-def migrate_db(conn: redis.Redis, from_ver: str, to_ver: str):
+def migrate_db(conn: redis.Redis, from_ver: str, to_ver: str, duty: float = 0.5):
     ver_key = (from_ver, to_ver)
     if ver_key not in migrations:
         conn.close()
         raise ValueError(f"Can not find migration for: {from_ver} -> {to_ver}")
-    f = migrations[ver_key]
-    print(f'Running database migration: {from_ver} -> {to_ver} ({f})')
-    f(conn)
+    m = migrations[ver_key]
+    print(f'Running database migration: {from_ver} -> {to_ver} ({m.match})')
+    run_chunked(conn, m, from_ver, to_ver, duty)
@@ -0,0 +1,132 @@
+import time
+from fnmatch import fnmatchcase
+from typing import Callable, Optional, NamedTuple, List, Dict
+
+import redis
+
+from ..names import VERSION, migration_key
+from ..utils import ENCODING
+
+# A chunk is sized to take about TARGET_CHUNK_SECONDS of Redis time, then the migration sleeps
+# so that it keeps Redis busy at most ``duty`` of the wall time.
+TARGET_CHUNK_SECONDS = 0.05
+MIN_CHUNK = 10
+MAX_CHUNK = 5000
+
+
+class ChunkedMigration(NamedTuple):
+    """
+    Rewrites every string key matching ``match`` with ``transform``, which returns the new value
+    or None to leave the key unchanged. Old and new layouts must both stay readable while it
+    runs, since workers keep running during the migration.
+    """
+    match: str
+    transform: Callable[[bytes, bytes], Optional[bytes]]
+
+
+class Checkpoint(NamedTuple):
+    cursor: int
+    scanned: int
+    migrated: int
+    started: float
+    done: bool
+
+
+def read_checkpoint(conn: redis.Redis, from_ver: str, to_ver: str) -> Optional[Checkpoint]:
+    return parse_checkpoint(conn.hgetall(migration_key(from_ver, to_ver)))
+
+
+def parse_checkpoint(d: Dict[bytes, bytes]) -> Optional[Checkpoint]:
+    if not d:
+        return None
+    return Checkpoint(
+        cursor=int(d[b'cursor']),
+        scanned=int(d[b'scanned']),
+        migrated=int(d[b'migrated']),
+        started=float(d[b'started']),
+        done=d[b'done'] == b'1'
+    )
+
+
+def _write_checkpoint(p: redis.client.Pipeline, from_ver: str, to_ver: str, cp: Checkpoint):
+    p.hset(migration_key(from_ver, to_ver), mapping=dict(
+        cursor=cp.cursor,
+        scanned=cp.scanned,
+        migrated=cp.migrated,
+        started=cp.started,
+        done=int(cp.done)
+    ))
+
+
+def _migrate_chunk(p: redis.client.Pipeline, migration: ChunkedMigration, keys: List[bytes]) -> int:
+    # Leaves ``p`` in MULTI mode with the rewrites queued. The keys are watched, so the
+    # transaction fails instead of clobbering a worker's concurrent write.
+    keys = [k for k in keys if fnmatchcase(k.decode(ENCODING), migration.match)]
+    if keys:
+        p.watch(*keys)
+        values = p.mget(keys)
+    else:
+        values = []
+    p.multi()
+    n = 0
+    for k, v in zip(keys, values):
+        if v is None:
+            continue
+        new_v = migration.transform(k, v)
+        if new_v is not None and new_v != v:
+            p.set(k, new_v)
+            n += 1
+    return n
+
+
+def _report(cp: Checkpoint, total: int):
+    elapsed = time.time() - cp.started
+    fraction = min(cp.scanned / total, 1) if total else 1
+    eta = elapsed / fraction - elapsed if fraction > 0 else float('inf')
+    print(f"{fraction:6.1%} scanned {cp.scanned}/{total}, migrated {cp.migrated}, "
+          f"elapsed {elapsed:.0f}s, eta {eta:.0f}s")
+
+
+def run_chunked(conn: redis.Redis, migration: ChunkedMigration, from_ver: str, to_ver: str,
+                duty: float = 0.5, report_every: float = 5):
+    cp = read_checkpoint(conn, from_ver, to_ver)
+    if cp is None:
+        cp = Checkpoint(cursor=0, scanned=0, migrated=0, started=time.time(), done=False)
+    elif cp.done:
+        print(f"Migration {from_ver} -> {to_ver} already finished")
+        return
+    else:
+        print(f"Resuming migration {from_ver} -> {to_ver} at cursor {cp.cursor}")
+    total = conn.dbsize()
+    chunk = 100
+    last_report = 0.0
+    while True:
+        t0 = time.time()
+        cursor, keys = conn.scan(cp.cursor, count=chunk)
+        with conn.pipeline() as p:
+            while True:
+                try:
+                    migrated = _migrate_chunk(p, migration, keys)
+                    next_cp = cp._replace(cursor=cursor, scanned=cp.scanned + len(keys),
+                                          migrated=cp.migrated + migrated, done=cursor == 0)
+                    _write_checkpoint(p, from_ver, to_ver, next_cp)
+                    if next_cp.done:
+                        p.set(VERSION, to_ver.encode(ENCODING))
+                    p.execute()
+                    break
+                except redis.WatchError:
+                    p.reset()
+        cp = next_cp
+        busy = time.time() - t0
+        if cp.done:
+            break
+        if busy > TARGET_CHUNK_SECONDS:
+            chunk = max(chunk // 2, MIN_CHUNK)
+        elif busy < TARGET_CHUNK_SECONDS / 2:
+            chunk = min(chunk * 2, MAX_CHUNK)
+        if time.time() - last_report > report_every:
+            _report(cp, total)
+            last_report = time.time()
+        time.sleep(busy * (1 - duty) / duty)
+    _report(cp, total)
+    print(f"Migration {from_ver} -> {to_ver} finished")
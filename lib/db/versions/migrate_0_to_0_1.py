@@ -1,13 +1,20 @@
 import json
-
-import redis
+from typing import Optional
 
 from lib.db.utils import ENCODING
+from lib.utils import DEFAULT_TAGS
+from .chunked import ChunkedMigration
+
+
+def _add_tags(key: bytes, raw: bytes) -> Optional[bytes]:
+    data = json.loads(raw.decode(ENCODING))
+    if 'tags' in data:
+        return None
+    data['tags'] = list(DEFAULT_TAGS)
+    return json.dumps(data).encode(ENCODING)
 
 
-def migrate(conn: redis.Redis):
-    pass
-    # for key in conn.keys("stbot.data:*"):
-    #     data = json.loads(conn[key].decode(ENCODING))
-    #     data['tags'] = ['default']
-    #     conn[key] = json.dumps(data)
+# Version 0.1 code writes tags itself and UMessage.parse defaults missing ones, so both layouts stay
+# readable while this runs. Records written behind the cursor by workers still on version 0 keep
+# reading as DEFAULT_TAGS; stop those workers first to have every record carry its tags.
+migration = ChunkedMigration(match="stbot.data:*", transform=_add_tags)
@@ -0,0 +1,107 @@
+import fcntl
+import os
+from pathlib import Path
+from typing import List, Tuple, Sequence, Iterable
+
+import numpy as np
+
+from lib.db import UDB
+
+index_root = Path('image_index')
+INDEX_FILE = 'hashes.npy'
+LOCK_FILE = 'hashes.lock'
+UID_WIDTH = 64
+
+INDEX_DTYPE = np.dtype([('h', '<u8'), ('u', f'S{UID_WIDTH}')])
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def _hash_value(h: bytes) -> np.uint64:
+    return np.frombuffer(h, dtype='<u8')[0]
+
+
+def to_records(entries: Sequence[Tuple[bytes, str]]) -> np.ndarray:
+    records = np.empty(len(entries), dtype=INDEX_DTYPE)
+    for i, (h, uid) in enumerate(entries):
+        records[i] = (_hash_value(h), uid.encode('utf-8'))
+    return records
+
+
+def nearest(records: np.ndarray, h: bytes, max_distance: int) -> List[Tuple[int, str]]:
+    if not len(records):
+        return []
+    dist = _popcount(np.bitwise_xor(records['h'], _hash_value(h)))
+    hit = np.flatnonzero(dist <= max_distance)
+    return [(int(dist[i]), records['u'][i].decode('utf-8')) for i in hit]
+
+
+class ImageIndex:
+    def __init__(self, root: Path = index_root):
+        self.path = root / INDEX_FILE
+        self.records = np.empty(0, dtype=INDEX_DTYPE)
+        self._mtime = None
+        self.refresh()
+
+    def __len__(self):
+        return len(self.records)
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            self.records = np.load(self.path, mmap_mode='r')
+            self._mtime = mtime
+
+    def search(self, h: bytes, tail: Sequence[Tuple[bytes, str]] = (),
+               max_distance: int = 10, limit: int = 5) -> List[Tuple[int, str]]:
+        best = {}
+        for d, uid in nearest(self.records, h, max_distance) + nearest(to_records(tail), h, max_distance):
+            if uid not in best or d < best[uid]:
+                best[uid] = d
+        return sorted(((d, u) for u, d in best.items()), key=lambda x: x[0])[:limit]
+
+
+def write_index(old: np.ndarray, chunks: Iterable[np.ndarray], total: int, root: Path = index_root):
+    # The new file is filled beside the old one and swapped in, so a reader never maps a half-written index.
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / (INDEX_FILE + '.tmp')
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=INDEX_DTYPE, shape=(total,))
+    out[:len(old)] = old
+    n = len(old)
+    for chunk in chunks:
+        out[n:n + len(chunk)] = chunk
+        n += len(chunk)
+    out.flush()
+    del out
+    os.replace(tmp, root / INDEX_FILE)
+
+
+def update_index(db: UDB, chunk_size: int = 10000, root: Path = index_root) -> int:
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / LOCK_FILE, 'w') as lock:
+        # telegram_search's hourly job and build_image_index.py may run at once; only one writes at a time.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        old = ImageIndex(root).records
+        total = db.image_hash_count()
+        if total < len(old):
+            # The log does not reach what the file holds (e.g. Redis was restored from an older
+            # backup), so nothing in it is known to be indexed.
+            return 0
+        if total > len(old):
+            chunks = (
+                to_records(db.image_hash_range(start, min(start + chunk_size, total) - 1))
+                for start in range(len(old), total, chunk_size)
+            )
+            write_index(old, chunks, total, root)
+        # Everything in the file is dropped from Redis, including what an interrupted run left behind.
+        db.image_hash_trim(total)
+        return total - len(old)
@@ -0,0 +1,55 @@
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+_SAMPLE_SIZE = 32
+# Besides the whole image, windows of these sizes at the corners, edge midpoints and centre are
+# hashed, so a copy cropped by up to about a tenth still lies close to one of them.
+CROP_SCALES = (0.9, 0.8)
+_ANCHORS = (0, 0.5, 1)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] /= np.sqrt(2)
+    return m * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(_SAMPLE_SIZE)
+
+
+def _gray(img: Image.Image) -> Image.Image:
+    img.draft('L', (_SAMPLE_SIZE * 4, _SAMPLE_SIZE * 4))
+    return img.convert('L')
+
+
+def _hash(gray: Image.Image) -> bytes:
+    gray = gray.resize((_SAMPLE_SIZE, _SAMPLE_SIZE), Image.LANCZOS)
+    dct = _DCT @ np.asarray(gray, dtype=np.float64) @ _DCT.T
+    low = dct[:HASH_SIZE, :HASH_SIZE].flatten()
+    return np.packbits(low > np.median(low[1:])).tobytes()
+
+
+def image_hash(img: Image.Image) -> bytes:
+    # 64-bit DCT hash: signs of the lowest frequencies against their median survive rescaling and
+    # recompression, and two hashes compare by Hamming distance. Crops shift them too far.
+    return _hash(_gray(img))
+
+
+def image_hashes(img: Image.Image) -> List[bytes]:
+    # What the index stores per image: the whole image, then each crop window. Queries hash only
+    # the whole image they were given.
+    gray = _gray(img)
+    w, h = gray.size
+    hashes = [_hash(gray)]
+    for s in CROP_SCALES:
+        cw, ch = w * s, h * s
+        for ay in _ANCHORS:
+            for ax in _ANCHORS:
+                x, y = (w - cw) * ax, (h - ch) * ay
+                hashes.append(_hash(gray.crop((round(x), round(y), round(x + cw), round(y + ch)))))
+    return hashes
@@ -0,0 +1,237 @@
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Iterator
+
+import redis
+from redis.cluster import RedisCluster, ClusterPipeline
+
+log_root = Path('log')
+_DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db')
+# Frames above the Redis call that are searched for the UDB method; deeper lib/db callers are not seen.
+_CALLER_DEPTH = 16
+
+# Redis round trips are only counted when asked for, with --profile or STBOT_PROFILE=1.
+_enabled = os.environ.get('STBOT_PROFILE', '') not in ('', '0')
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+        self.commands = 0
+        self.seconds = 0.0
+
+    def add(self, commands: int, seconds: float):
+        self.calls += 1
+        self.commands += commands
+        self.seconds += seconds
+
+
+class Stats:
+    def __init__(self):
+        self.start = time.time()
+        self.redis = Counter()
+        self.by_command: Dict[str, Counter] = defaultdict(Counter)
+        self.by_method: Dict[str, Counter] = defaultdict(Counter)
+        self.external: Dict[str, Counter] = defaultdict(Counter)
+        # Workers share one Stats from several threads.
+        self.lock = threading.Lock()
+
+    def add_round_trip(self, commands: List[str], seconds: float):
+        method = _calling_method()
+        share = seconds / max(len(commands), 1)
+        with self.lock:
+            self.redis.add(len(commands), seconds)
+            self.by_method[method].add(len(commands), seconds)
+            for c in commands:
+                self.by_command[c].add(1, share)
+
+    def add_external(self, category: str, seconds: float):
+        with self.lock:
+            self.external[category].add(1, seconds)
+
+    def summary(self, name: str) -> str:
+        with self.lock:
+            return self._summary(name)
+
+    def _summary(self, name: str) -> str:
+        parts = [
+            f"[{name}] {time.time() - self.start:.1f}s",
+            f"redis {self.redis.commands} cmds/{self.redis.calls} rtt {self.redis.seconds:.2f}s",
+        ]
+        for k, c in sorted(self.external.items()):
+            parts.append(f"{k} {c.calls} {c.seconds:.2f}s")
+        # Methods with many round trips per call are where loops should become pipelines.
+        top = sorted(self.by_method.items(), key=lambda kv: -kv[1].calls)[:3]
+        if top:
+            parts.append("top " + ", ".join(f"{k} {c.calls}rtt" for k, c in top))
+        return " | ".join(parts)
+
+    def report(self) -> str:
+        with self.lock:
+            return self._report()
+
+    def _report(self) -> str:
+        out = io.StringIO()
+        for title, table in (('redis command', self.by_command), ('UDB method', self.by_method),
+                             ('external', self.external)):
+            print(f"{title:<32}{'calls':>10}{'cmds':>10}{'seconds':>12}", file=out)
+            for k, c in sorted(table.items(), key=lambda kv: -kv[1].seconds):
+                print(f"{k:<32}{c.calls:>10}{c.commands:>10}{c.seconds:>12.4f}", file=out)
+            print(file=out)
+        return out.getvalue()
+
+
+STATS = Stats()
+
+
+def _calling_method() -> str:
+    # The outermost frame inside lib/db is the UDB method the caller actually invoked.
+    name = '-'
+    f = sys._getframe(3)
+    for _ in range(_CALLER_DEPTH):
+        if f is None:
+            break
+        if f.f_code.co_filename.startswith(_DB_DIR):
+            name = f.f_code.co_name
+        f = f.f_back
+    return name
+
+
+@contextmanager
+def timed(category: str):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STATS.add_external(category, time.perf_counter() - start)
+
+
+def _command_name(args) -> str:
+    c = args[0]
+    return c.decode() if isinstance(c, bytes) else str(c).upper()
+
+
+class ProfiledPipeline(redis.client.Pipeline):
+    def immediate_execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            STATS.add_round_trip([_command_name(args)], time.perf_counter() - start)
+
+    def execute(self, raise_on_error: bool = True):
+        commands = [_command_name(args) for args, _ in self.command_stack]
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            if commands:
+                STATS.add_round_trip(commands, time.perf_counter() - start)
+
+
+class ProfiledRedis(redis.StrictRedis):
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            STATS.add_round_trip([_command_name(args)], time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> ProfiledPipeline:
+        return ProfiledPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class ProfiledClusterPipeline(ClusterPipeline):
+    # Set up by ProfiledRedisCluster.pipeline; the cluster pipeline keeps its queue in a private strategy.
+    commands: List[str]
+
+    def execute_command(self, *args, **kwargs):
+        self.commands.append(_command_name(args))
+        return super().execute_command(*args, **kwargs)
+
+    def execute(self, raise_on_error: bool = True):
+        commands, self.commands = self.commands, []
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            if commands:
+                STATS.add_round_trip(commands, time.perf_counter() - start)
+
+
+class ProfiledRedisCluster(RedisCluster):
+    def execute_command(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **kwargs)
+        finally:
+            STATS.add_round_trip([_command_name(args)], time.perf_counter() - start)
+
+    def pipeline(self, transaction=None, shard_hint=None) -> ProfiledClusterPipeline:
+        p = super().pipeline(transaction, shard_hint)
+        p.__class__ = ProfiledClusterPipeline
+        p.commands = []
+        return p
+
+
+class _ProfileAction(argparse.Action):
+    # Turned on while parsing, so connections opened afterwards are already the profiled ones.
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=False, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        enable()
+        setattr(namespace, self.dest, True)
+
+
+def add_profile_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--profile', action=_ProfileAction,
+                        help=f'count Redis round trips and write a cProfile report of this run to {log_root}/')
+
+
+@contextmanager
+def profile_run(name: str, profile: bool = False) -> Iterator[Stats]:
+    prof = cProfile.Profile() if profile else None
+    if prof is not None:
+        prof.enable()
+    try:
+        yield STATS
+    finally:
+        if prof is not None:
+            prof.disable()
+            _write_report(name, prof)
+        if _enabled:
+            print(STATS.summary(name), file=sys.stderr)
+
+
+def _write_report(name: str, prof: cProfile.Profile):
+    log_root.mkdir(parents=True, exist_ok=True)
+    base = log_root / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}"
+    prof.dump_stats(f"{base}.prof")
+    with open(f"{base}.txt", 'w') as f:
+        print(STATS.summary(name), file=f)
+        print(file=f)
+        f.write(STATS.report())
+        pstats.Stats(prof, stream=f).sort_stats('cumulative').print_stats(50)
+    print(f"Profile written to {base}.txt", file=sys.stderr)
@@ -0,0 +1,59 @@
+import re
+from collections import defaultdict
+from typing import List, Optional, Tuple, Dict
+
+from lib.utils import UMessage, MessageType
+
+_URL = re.compile(r'https?://\S+')
+_WORD = re.compile(r'\w+')
+# Scripts written without spaces are indexed as overlapping character bigrams.
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+_MAX_TOKEN = 32
+_TWITTER_EPOCH_MS = 1288834974657
+
+
+def _cjk_tokens(run: str) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> List[str]:
+    text = _URL.sub(' ', text.lower())
+    tokens = []
+    for w in _WORD.findall(text):
+        pos = 0
+        for m in _CJK.finditer(w):
+            if m.start() > pos:
+                tokens.append(w[pos:m.start()])
+            tokens.extend(_cjk_tokens(m.group()))
+            pos = m.end()
+        if pos < len(w):
+            tokens.append(w[pos:])
+    seen = set()
+    return [
+        t for t in tokens
+        if len(t) <= _MAX_TOKEN and (len(t) > 1 or _CJK.match(t)) and not (t in seen or seen.add(t))
+    ]
+
+
+def char_bigrams(tokens: List[str]) -> Dict[str, List[str]]:
+    # The CJK bigrams each character occurs in, which a one-character query is answered from.
+    out = defaultdict(list)
+    for t in tokens:
+        if len(t) == 2 and _CJK.fullmatch(t):
+            for c in set(t):
+                out[c].append(t)
+    return out
+
+
+def parse_query(query: str) -> Tuple[List[str], List[str]]:
+    authors = [a[1:].lower() for a in query.split() if a.startswith('@') and len(a) > 1]
+    words = ' '.join(a for a in query.split() if not a.startswith('@'))
+    return authors, tokenize(words)
+
+
+def message_time(msg: UMessage) -> Optional[float]:
+    if msg.type == MessageType.Twitter and str(msg.id).isdigit():
+        return ((int(msg.id) >> 22) + _TWITTER_EPOCH_MS) / 1000
+    return None
@@ -0,0 +1,39 @@
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List
+
+from lib.db import UDB
+from lib.utils import UMessage, MessageType
+
+INGEST_BATCH = 100
+
+
+class Source(ABC):
+    """
+    A crawler for one service. ``produce`` yields candidate messages as they are found and may
+    yield ones that are already stored; ``ingest`` drops those and writes the rest in batches.
+    """
+    type: MessageType
+
+    @abstractmethod
+    def produce(self, db: UDB) -> Iterator[UMessage]:
+        pass
+
+
+def ingest(db: UDB, messages: Iterable[UMessage], batch_size: int = INGEST_BATCH) -> int:
+    added = 0
+    batch: List[UMessage] = []
+    for msg in messages:
+        batch.append(msg)
+        if len(batch) >= batch_size:
+            added += _flush(db, batch)
+            batch = []
+    if batch:
+        added += _flush(db, batch)
+    return added
+
+
+def _flush(db: UDB, batch: List[UMessage]) -> int:
+    new = db.download_add_many(batch)
+    for msg in new:
+        print(msg)
+    return len(new)
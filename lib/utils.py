@@ -1,11 +1,11 @@
 import json
 from enum import Enum
-from typing import NamedTuple, AnyStr, List, Dict
+from typing import NamedTuple, AnyStr, List, Dict, Tuple
 
 
 class MessageType(Enum):
     Twitter = 'twitter'
-    # Pixiv = 'pixiv'
+    Pixiv = 'pixiv'
 
 
 class TargetType(Enum):
@@ -13,7 +13,8 @@ class TargetType(Enum):
 
 
 _user_base_url: Dict[MessageType, str] = {
-    MessageType.Twitter: 'https://twitter.com/{username}'
+    MessageType.Twitter: 'https://twitter.com/{username}',
+    MessageType.Pixiv: 'https://www.pixiv.net/users/{username}',
 }
 
 
@@ -21,6 +22,10 @@ def get_user_home_page_url(type_: MessageType, author: str):
     return _user_base_url[type_].format(username=author)
 
 
+# Records written before database version 0.1 have no tags and read as these.
+DEFAULT_TAGS = ('default',)
+
+
 class UMessage(NamedTuple):
     id: AnyStr
     type: MessageType
@@ -29,6 +34,7 @@ class UMessage(NamedTuple):
     content: AnyStr
     author: AnyStr
     media_list: List[AnyStr]
+    tags: Tuple[AnyStr, ...] = DEFAULT_TAGS
 
     @property
     def uid(self):
@@ -42,7 +48,8 @@ class UMessage(NamedTuple):
             source=self.source,
             content=self.content,
             author=self.author,
-            media_list=self.media_list
+            media_list=self.media_list,
+            tags=list(self.tags)
         ))
 
     @classmethod
@@ -55,7 +62,8 @@ class UMessage(NamedTuple):
             content=d['content'],
             author=d['author'],
             media_list=d['media_list'],
-            monitor=d['monitor']
+            monitor=d['monitor'],
+            tags=tuple(d.get('tags', DEFAULT_TAGS))
         )
 
 
@@ -0,0 +1,125 @@
+import argparse
+import math
+import signal
+import sys
+import time
+from typing import Callable, Optional, Iterator, List
+
+from lib.db import UDB
+from lib.utils import MessageStatus, UMessage
+
+COST_ALPHA = 0.2
+COST_MARGIN = 1.5
+
+
+class Deadline:
+    """
+    Time budget of one run, ``at`` being a unix timestamp or None for no limit. The seconds one
+    item of ``status`` takes are kept as an exponentially weighted average in Redis, so the next
+    run starts from what the previous ones measured.
+    """
+
+    def __init__(self, db: UDB, status: MessageStatus, at: Optional[float] = None):
+        self.db = db
+        self.status = status
+        self.at = at
+        self.cost = db.stage_cost_get(status)
+
+    def remaining(self) -> float:
+        return math.inf if self.at is None else self.at - time.time()
+
+    def allowance(self, n: int) -> int:
+        # How many of n items can still be finished, with a margin for items slower than average.
+        if self.at is None:
+            return n
+        remaining = self.remaining()
+        if remaining <= 0:
+            return 0
+        if self.cost is None:
+            # Nothing measured yet: take items one at a time until there is an estimate.
+            return min(n, 1)
+        if self.cost <= 0:
+            return n
+        return max(min(n, int(remaining / (self.cost * COST_MARGIN))), 0)
+
+    def record(self, seconds: float):
+        self.cost = seconds if self.cost is None else self.cost + COST_ALPHA * (seconds - self.cost)
+        self.db.stage_cost_set(self.status, self.cost)
+
+
+def add_deadline_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--deadline', type=float,
+                        help='unix time to finish by; items that would not finish in time are left queued')
+
+
+def poll_within(db: UDB, status: MessageStatus, limit: Optional[int], deadline: Deadline) -> Iterator[UMessage]:
+    """
+    Yields up to ``limit`` messages of ``status``, popping only as many at a time as the deadline
+    allows and timing each one until the next is asked for. Messages popped but not handed out
+    when the deadline stops the run (or the caller stops early) are pushed back.
+    """
+    remaining = -1 if limit is None else limit
+    batch: List[UMessage] = []
+    current: Optional[UMessage] = None
+    try:
+        while remaining != 0:
+            batch_size = db.poll_batch_limit(status)
+            n = deadline.allowance(batch_size if remaining < 0 else min(batch_size, remaining))
+            if n == 0:
+                break
+            batch = list(db.iter_poll(status, n, n))
+            if not batch:
+                break
+            if remaining > 0:
+                remaining -= len(batch)
+            while batch:
+                if deadline.allowance(1) == 0:
+                    return
+                current = batch.pop(0)
+                start = time.time()
+                yield current
+                current = None
+                deadline.record(time.time() - start)
+    finally:
+        uids = [m.uid for m in batch]
+        if current is not None and _terminating:
+            # The item SIGTERM cut off goes back too; push_back skips it if it already left the stage.
+            uids.insert(0, current.uid)
+        db.push_back(status, uids)
+
+
+_terminating = False
+
+
+def _exit_on_sigterm(*_):
+    global _terminating
+    _terminating = True
+    sys.exit(128 + signal.SIGTERM)
+
+
+def run_stage(db: UDB, status: MessageStatus, step: Callable[[], int], follow: bool,
+              downstream: Optional[MessageStatus] = None, idle_timeout: float = 60,
+              deadline: Optional[Deadline] = None):
+    """
+    Runs ``step`` once, or with ``follow`` keeps running it, sleeping until something is pushed
+    to ``status`` (or ``downstream`` drains, which reopens a full backpressure window) or a
+    delayed retry of the stage becomes due. ``step`` returns how many items it handled.
+    A ``follow`` run with a ``deadline`` returns once it has passed.
+    """
+    # timeout and docker stop send SIGTERM; exiting through SystemExit lets poll_within push back its batch.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    if not follow:
+        step()
+        return
+    wake_on = [status] if downstream is None else [status, downstream]
+    with db.subscribe(*wake_on) as notifier:
+        while deadline is None or deadline.remaining() > 0:
+            if step() > 0:
+                continue
+            timeout = idle_timeout
+            retry_in = db.next_retry_in(status)
+            if retry_in is not None:
+                timeout = min(timeout, retry_in)
+            if deadline is not None:
+                timeout = min(timeout, deadline.remaining())
+            notifier.wait(max(timeout, 0))
@@ -1,6 +1,9 @@
+import re
+import time
+from datetime import datetime
 from functools import partial
 from operator import itemgetter
-from typing import Optional, List, Dict, Tuple, Set
+from typing import Optional, List, Dict, Tuple, Set, Any
 
 import flask
 
@@ -11,29 +14,64 @@ from lib.utils import MessageType, get_user_home_page_url
 app = flask.Flask(__name__)
 db: Optional[UDB] = None
 URL_ROOT: str = ''
+PAGE_SIZE = 100
+COUNTS_TTL = 5
+_counts_cache: Tuple[float, Dict[str, int]] = (0, {})
+
+
+def get_counts() -> Dict[str, int]:
+    global _counts_cache
+    ts, counts = _counts_cache
+    if time.time() - ts > COUNTS_TTL:
+        counts = db.queue_counts()
+        _counts_cache = (time.time(), counts)
+    return counts
+
+
+def get_monitors(type_: MessageType, q: str, after: Optional[str]) -> Dict[str, Any]:
+    names = db.monitor_page(type_, prefix=q, after=after, limit=PAGE_SIZE)
+    return dict(
+        monitors=names,
+        next=names[-1] if len(names) == PAGE_SIZE else None,
+        total=db.monitor_count(type_)
+    )
 
 
 def get_page():
-    services = [
-        (t.value, db.monitor_list(t), partial(get_user_home_page_url, t))
-        for t in MessageType
-    ]
-    download_n = db.download_count()
-    post_n = db.post_count()
-    success_n = db.success_count()
-    failed_n = db.failed_count()
-    cleaned_n = db.clean_count()
+    selected = flask.request.args.get('type')
+    q = flask.request.args.get('q', '')
+    after = flask.request.args.get('after')
+    services = []
+    for t in MessageType:
+        if t.value == selected:
+            page = get_monitors(t, q, after)
+        else:
+            page = get_monitors(t, '', None)
+        services.append((t.value, page, partial(get_user_home_page_url, t), db.monitor_weights(t)))
+    counts = get_counts()
     return flask.render_template('index.html',
                                  services=services,
-                                 download_n=download_n,
-                                 post_n=post_n,
-                                 success_n=success_n,
-                                 failed_n=failed_n,
-                                 cleaned_n=cleaned_n,
+                                 selected=selected,
+                                 q=q,
+                                 download_n=counts['download'],
+                                 post_n=counts['post'],
+                                 success_n=counts['success'],
+                                 failed_n=counts['failed'],
+                                 retrying_n=counts['retrying'],
+                                 cleaned_n=counts['cleaned'],
                                  URL_ROOT=URL_ROOT
                                  )
 
 
+def _form_names() -> List[str]:
+    return [
+        n
+        for v in flask.request.form.getlist('name')
+        for n in re.split(r'[\s,]+', v)
+        if n
+    ]
+
+
 @app.route("/", methods=["GET"])
 def home_page():
     return get_page()
@@ -45,7 +83,7 @@ def rel_page(type_):
     rels = db.relation_query(type_)
     rec_c = {}
     rec_v = {}
-    monitors = db.monitor_list(type_)
+    monitors = set(db.monitor_list(type_))
     home_url = partial(get_user_home_page_url, type_)
     for (src, dst), ctr in rels.items():
         if dst in monitors:
@@ -63,22 +101,80 @@ def rel_page(type_):
     recommends.sort(key=itemgetter(1), reverse=True)
     return flask.render_template('relation.html', service=type_.value, recommends=recommends, home_url=home_url)
 
+
+@app.route("/timeline", methods=["GET"])
+def timeline_lookup():
+    uid = flask.request.args.get('uid', '').strip()
+    return flask.redirect(f"{URL_ROOT}/timeline/{uid}")
+
+
+@app.route("/timeline/<uid>", methods=["GET"])
+def timeline_page(uid):
+    events = db.events(uid)
+    try:
+        status = db.get_status(uid).value
+    except KeyError:
+        # Cleaned or expired messages may have lost their status key; the template shows "unknown".
+        status = None
+    if status is None and not events:
+        flask.abort(404)
+    return flask.render_template('timeline.html', uid=uid, status=status, events=events, datetime=datetime)
+
+@app.route("/monitors/<type_>", methods=["GET"])
+def monitors_api(type_):
+    type_ = MessageType(type_)
+    q = flask.request.args.get('q', '')
+    after = flask.request.args.get('after')
+    return flask.jsonify(get_monitors(type_, q, after))
+
+
+@app.route("/search", methods=["GET"])
+def search_api():
+    q = flask.request.args.get('q', '')
+    try:
+        page = int(flask.request.args.get('page', 1))
+    except ValueError:
+        flask.abort(400)
+    if page < 1:
+        flask.abort(400)
+    total, results = db.search(q, (page - 1) * PAGE_SIZE, PAGE_SIZE)
+    return flask.jsonify(dict(
+        total=total,
+        page=page,
+        results=[
+            dict(uid=m.uid, author=m.author, content=m.content, source=m.source)
+            for m in results
+        ]
+    ))
+
+
 @app.route("/add", methods=["POST"])
 def add_monitor():
     service = flask.request.form['type']
-    name = flask.request.form['name']
+    names = _form_names()
     type_ = MessageType(service)
-    db.monitor_add(type_, name)
-    print(type_, name)
+    db.monitor_add_many(type_, names)
+    print(type_, names)
     return flask.redirect(flask.request.url_root)
 
 
 @app.route("/delete", methods=["POST"])
 def delete_monitor():
     service = flask.request.form['type']
-    name = flask.request.form['name']
+    names = _form_names()
     type_ = MessageType(service)
-    db.monitor_remove(type_, name)
+    db.monitor_remove_many(type_, names)
+    return flask.redirect(flask.request.url_root)
+
+
+@app.route("/weight", methods=["POST"])
+def set_monitor_weight():
+    type_ = MessageType(flask.request.form['type'])
+    name = flask.request.form['name']
+    weight = float(flask.request.form['weight'])
+    if weight <= 0:
+        flask.abort(400)
+    db.monitor_weight_set(type_, name, weight)
     return flask.redirect(flask.request.url_root)
 
 
@@ -86,5 +182,7 @@ if __name__ == '__main__':
     with open('config.toml') as cf:
         config = parse(cf)
     with UDB(config.redis) as db:
+        for t in MessageType:
+            db.monitor_reindex(t)
         URL_ROOT = config.manage.root_url
         app.run(host=config.manage.host, port=config.manage.port, debug=config.manage.debug)
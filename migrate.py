@@ -0,0 +1,28 @@
+import argparse
+
+from lib.config import parse
+from lib.db import migrate_db, get_db_version
+from lib.db.udb import connect_db
+from lib.profiling import add_profile_argument, profile_run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run or resume a database migration. Workers of the new version '
+                                                 'may keep running; stop the old ones first')
+    parser.add_argument('to_version')
+    parser.add_argument('--duty', type=float, default=0.5, help='fraction of wall time the migration keeps Redis busy')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    conn = connect_db(config.redis)
+    try:
+        with profile_run('migrate', args.profile):
+            from_ver = get_db_version(conn) or '0'
+            migrate_db(conn, from_ver, args.to_version, args.duty)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,97 @@
+import argparse
 import os
+import sys
+from typing import Iterator, List
 
 from pixivpy3 import AppPixivAPI
 
+from lib.config import PixivConfig, parse
+from lib.db import UDB
+from lib.profiling import add_profile_argument, profile_run, timed
+from lib.source import Source, ingest
+from lib.utils import UMessage, MessageType
+
 ACCESS_TOKEN_FILE = 'cache/pixiv_refresh_token.txt'
+MAX_PAGES = 3
+
 
-def login(api: AppPixivAPI):
-    username = 'viff_automator@yahoo.co.jp'
-    password = '93jE!L#7mTHhAB'
+def login(config: PixivConfig) -> AppPixivAPI:
+    api = AppPixivAPI()
+    if config.api_host:
+        api.hosts = config.api_host.rstrip('/')
+    if not config.refresh_token:
+        # A local stand-in accepts any token, so there is nothing to authenticate against.
+        api.set_auth('local')
+        return api
+    token = config.refresh_token
     if os.path.exists(ACCESS_TOKEN_FILE):
         with open(ACCESS_TOKEN_FILE) as f:
-            token = f.read()
-        api.auth(username=username, refresh_token=token)
-    else:
-        api.auth(username=username, password=password)
+            token = f.read().strip()
+    api.auth(refresh_token=token)
+    # Pixiv rotates the refresh token on every login.
+    os.makedirs(os.path.dirname(ACCESS_TOKEN_FILE), exist_ok=True)
     with open(ACCESS_TOKEN_FILE, 'w') as f:
         f.write(api.refresh_token)
+    return api
+
+
+def _illust_message(mu: str, illust) -> UMessage:
+    original = illust['meta_single_page'].get('original_image_url')
+    media_list = [original] if original else [p['image_urls']['original'] for p in illust['meta_pages']]
+    return UMessage(
+        id=str(illust['id']),
+        type=MessageType.Pixiv,
+        monitor=mu,
+        source=f"https://www.pixiv.net/artworks/{illust['id']}",
+        content=illust['title'],
+        author=str(illust['user']['id']),
+        media_list=media_list
+    )
+
+
+class PixivSource(Source):
+    type = MessageType.Pixiv
+
+    def __init__(self, api: AppPixivAPI, monitors: List[str], max_pages: int = MAX_PAGES):
+        self.api = api
+        self.monitors = monitors
+        self.max_pages = max_pages
+
+    def produce(self, db: UDB) -> Iterator[UMessage]:
+        for mu in self.monitors:
+            yield from self._user_illusts(db, mu)
+
+    def _user_illusts(self, db: UDB, mu: str) -> Iterator[UMessage]:
+        kwargs = dict(user_id=mu)
+        for _ in range(self.max_pages):
+            with timed('pixiv'):
+                res = self.api.user_illusts(**kwargs)
+            if 'error' in res:
+                print(f"Failed to fetch illusts of {mu}: {res['error']}")
+                return
+            illusts = res['illusts']
+            seen = db.data_exists_many(f"{MessageType.Pixiv.value}_{i['id']}" for i in illusts)
+            for illust, s in zip(illusts, seen):
+                if not s:
+                    yield _illust_message(mu, illust)
+            # Works come newest first, so a page with stored ones is where the last run stopped.
+            if any(seen) or not res.get('next_url'):
+                return
+            kwargs = self.api.parse_qs(res['next_url'])
+
 
 def main():
-    api = AppPixivAPI()
-    login(api)
-    print(api.user_bookmarks_illust(4800296))
+    parser = argparse.ArgumentParser()
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    if config.pixiv is None:
+        sys.exit('No [pixiv] section in config.toml')
+    api = login(config.pixiv)
+    with profile_run('pixiv_crawler', args.profile), UDB(config.redis) as db:
+        ingest(db, PixivSource(api, db.monitor_list(MessageType.Pixiv)).produce(db))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,51 @@
+import argparse
+import time
+
+from lib.config import parse
+from lib.db import UDB
+from lib.db.names import DATA_PREFIX, SEARCH_TERM_PREFIX, SEARCH_AUTHOR_PREFIX, SEARCH_VOCAB_PREFIX, \
+    get_uid_from_key
+from lib.db.search import trim_postings
+from lib.db.utils import ENCODING
+from lib.profiling import add_profile_argument, profile_run
+
+CHUNK_SIZE = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the keyword and author search index from the stored messages')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    with profile_run('rebuild_search_index', args.profile), UDB(config.redis) as db:
+        # Drop the old posting lists first, so terms no longer indexed (e.g. CJK unigrams) go away.
+        for prefix in [SEARCH_TERM_PREFIX, SEARCH_AUTHOR_PREFIX, SEARCH_VOCAB_PREFIX]:
+            for k in db.conn.scan_iter(match=f"{prefix}:*", count=CHUNK_SIZE):
+                db.conn.unlink(k)
+        start = time.time()
+        n = 0
+        chunk = []
+        for k in db.conn.scan_iter(match=f"{DATA_PREFIX}:*", count=CHUNK_SIZE):
+            chunk.append(get_uid_from_key(k.decode(ENCODING)))
+            if len(chunk) >= CHUNK_SIZE:
+                db.search_index_add_many(m for m in db.get_data_many(chunk) if m is not None)
+                n += len(chunk)
+                chunk = []
+                print(f"Indexed {n} messages ({n / (time.time() - start):.0f}/s)")
+        if chunk:
+            db.search_index_add_many(m for m in db.get_data_many(chunk) if m is not None)
+            n += len(chunk)
+        print(f"Indexed {n} messages in {time.time() - start:.0f}s")
+        # Adds only trim now and then, so cut every list down to size once at the end.
+        for prefix in [SEARCH_TERM_PREFIX, SEARCH_AUTHOR_PREFIX]:
+            with db.conn.pipeline(transaction=False) as p:
+                for k in db.conn.scan_iter(match=f"{prefix}:*", count=CHUNK_SIZE):
+                    trim_postings(p, k)
+                    if len(p) >= CHUNK_SIZE:
+                        p.execute()
+                p.execute()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
+import argparse
+
 from lib.config import parse
 from lib.db import UDB
+from lib.profiling import add_profile_argument, profile_run
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Put tasks that are in no queue back on the queue of their status')
+    add_profile_argument(parser)
+    args = parser.parse_args()
     config = parse(open('config.toml'))
-    with UDB(config.redis) as db:
+    with profile_run('recover', args.profile), UDB(config.redis) as db:
         db.recover()
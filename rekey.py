@@ -0,0 +1,88 @@
+import argparse
+from typing import Callable, Iterable, Tuple
+
+from lib.config import parse
+from lib.db import names
+from lib.db.udb import connect_db
+from lib.profiling import add_profile_argument, profile_run
+from lib.utils import MessageType
+
+BATCH_SIZE = 1000
+
+
+def _strip_tag(rest: str) -> str:
+    return rest.strip('{}')
+
+
+def _strip_group(group: str) -> Callable[[str], str]:
+    tag = f"{{{group}}}:"
+    return lambda rest: rest[len(tag):] if rest.startswith(tag) else rest
+
+
+def _families() -> Iterable[Tuple[str, Callable[[str], str], Callable[[str], str]]]:
+    # (prefix, how to get the name part back from a key of either layout, the key name in the current one)
+    yield names.DATA_PREFIX, _strip_tag, names.data_key
+    yield names.STATUS_PREFIX, _strip_tag, names.status_key
+    yield names.FAILURE_STATUS_PREFIX, _strip_tag, names.get_failure_status
+    yield names.FAILURE_TIME_PREFIX, _strip_tag, names.failure_time_key
+    yield names.RETRY_COUNT_PREFIX, _strip_tag, names.retry_count_key
+    yield names.EVENT_PREFIX, _strip_tag, names.event_key
+    yield names.MONITOR_PREFIX, _strip_tag, lambda t: names.monitor_key(MessageType(t))
+    yield names.MONITOR_INDEX_PREFIX, _strip_tag, lambda t: names.monitor_index_key(MessageType(t))
+    yield names.SEARCH_TERM_PREFIX, _strip_group('search'), names.search_term_key
+    yield names.SEARCH_AUTHOR_PREFIX, _strip_group('search'), names.search_author_key
+    yield names.SEARCH_VOCAB_PREFIX, _strip_group('search'), names.search_vocab_key
+
+
+def rekey(conn, prefix: str, name_of: Callable[[str], str], key_of: Callable[[str], str]) -> int:
+    # Keys of the two layouts hash to different slots, so they are copied with DUMP/RESTORE rather
+    # than RENAME. RESTORE replaces, so an interrupted run can simply be started again.
+    moved = 0
+    batch = []
+
+    def flush():
+        nonlocal moved
+        p = conn.pipeline(transaction=False)
+        for old, _ in batch:
+            p.dump(old)
+        dumps = p.execute()
+        for (old, new), value in zip(batch, dumps):
+            if value is not None:
+                p.restore(new, 0, value, replace=True)
+                p.delete(old)
+                moved += 1
+        p.execute()
+        batch.clear()
+
+    for k in conn.scan_iter(match=f"{prefix}:*", count=BATCH_SIZE):
+        old = k.decode()
+        new = key_of(name_of(old[len(prefix) + 1:]))
+        if new != old:
+            batch.append((old, new))
+            if len(batch) >= BATCH_SIZE:
+                flush()
+    if batch:
+        flush()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rename per-message, monitor and search keys to the key layout of '
+                                                 'config.toml, e.g. after restoring a standalone backup into a cluster. '
+                                                 'Stop the workers first.')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    conn = connect_db(config.redis)
+    try:
+        with profile_run('rekey', args.profile):
+            for prefix, name_of, key_of in _families():
+                n = rekey(conn, prefix, name_of, key_of)
+                print(f"{prefix}: renamed {n} keys")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import argparse
+from typing import Iterable, Tuple
+
+from lib.config import parse
+from lib.db.names import URL_TO_FILE, REVERSED_INDEX_PREFIX, RELATION_PREFIX, RELATION_ID_PREFIX, \
+    shard_key, shard_keys
+from lib.db.udb import connect_db
+from lib.profiling import add_profile_argument, profile_run
+from lib.utils import MessageType, TargetType
+
+BATCH_SIZE = 1000
+
+
+def _families() -> Iterable[Tuple[str, str]]:
+    yield URL_TO_FILE, 'hash'
+    for t in TargetType:
+        yield f"{REVERSED_INDEX_PREFIX}:{t.value}", 'hash'
+    for t in MessageType:
+        yield f"{RELATION_PREFIX}:{t.value}", 'hash'
+        yield f"{RELATION_ID_PREFIX}:{t.value}", 'set'
+
+
+def reshard(conn, base: str, type_: str, old: int, new: int) -> int:
+    # Fields already on their new shard stay put, so an interrupted run can simply be started again.
+    moved = 0
+    for old_key in shard_keys(base, old):
+        p = conn.pipeline(transaction=False)
+        items = conn.hscan_iter(old_key, count=BATCH_SIZE) if type_ == 'hash' else \
+            ((m, None) for m in conn.sscan_iter(old_key, count=BATCH_SIZE))
+        for field, value in items:
+            new_key = shard_key(base, field, new)
+            if new_key == old_key:
+                continue
+            if type_ == 'hash':
+                p.hset(new_key, field, value)
+                p.hdel(old_key, field)
+            else:
+                p.sadd(new_key, field)
+                p.srem(old_key, field)
+            moved += 1
+            if moved % BATCH_SIZE == 0:
+                p.execute()
+        p.execute()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move url2file, reversed index and relation entries '
+                                                 'to the hash_shards count in config.toml. Stop the workers first.')
+    parser.add_argument('--from', dest='from_shards', type=int, required=True, help='hash_shards the data was written with')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    with open('config.toml') as cf:
+        config = parse(cf)
+    conn = connect_db(config.redis)
+    try:
+        with profile_run('reshard', args.profile):
+            for base, type_ in _families():
+                n = reshard(conn, base, type_, args.from_shards, config.redis.hash_shards)
+                print(f"{base}: moved {n} entries from {args.from_shards} to {config.redis.hash_shards} shards")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,55 @@
+import argparse
+
 from lib.config import parse
 from lib.db import UDB
+from lib.db.requeue import REQUEUE_CHUNK, RequeueFilter
+from lib.profiling import add_profile_argument, profile_run
+from lib.utils import MessageStatus
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_STAGES = [MessageStatus.Downloading, MessageStatus.Posting, MessageStatus.Success]
+
+
+def duration(s: str) -> float:
+    if s[-1:] in _UNITS:
+        return float(s[:-1]) * _UNITS[s[-1]]
+    return float(s)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Put failed tasks back on the queue of the stage they failed in',
+                                     epilog='Tasks are taken off the failed list before they are requeued. If a run '
+                                            'is cut short in between, recover.py puts them back on the failed list.')
+    parser.add_argument('--stage', action='append', choices=[s.value for s in _STAGES],
+                        help='only tasks that failed in this stage, may be repeated')
+    parser.add_argument('--monitor', action='append', help='only tasks of this monitor, may be repeated')
+    parser.add_argument('--older-than', type=duration, help='only failures at least this old, e.g. 30m, 2h, 7d')
+    parser.add_argument('--newer-than', type=duration, help='only failures at most this old')
+    parser.add_argument('--max-retries', type=int, help='only tasks retried at most this many times')
+    parser.add_argument('--dry-run', action='store_true', help='count matching tasks without requeueing them')
+    parser.add_argument('--chunk-size', type=int, default=REQUEUE_CHUNK)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    f = RequeueFilter(
+        stages=frozenset(MessageStatus(s) for s in args.stage) if args.stage else None,
+        monitors=frozenset(args.monitor) if args.monitor else None,
+        min_age=args.older_than,
+        max_age=args.newer_than,
+        max_retries=args.max_retries
+    )
     with open("config.toml") as cf:
         config = parse(cf)
-    with UDB(config.redis) as db:
-        print(db.failed_queue.list())
-        db.restart_failed_tasks()
+    with profile_run('restart_failed_tasks', args.profile), UDB(config.redis) as db:
+        try:
+            summary = db.requeue_failed(f, args.dry_run, args.chunk_size)
+        except BaseException:
+            if not args.dry_run:
+                print("Requeue interrupted; run recover.py to put back tasks taken off the failed list but not requeued")
+            raise
+    counts = ', '.join(f"{s.value} {n}" for s, n in sorted(summary.requeued.items(), key=lambda x: x[0].value))
+    action = 'Would requeue' if args.dry_run else 'Requeued'
+    print(f"{action} {sum(summary.requeued.values())} of {summary.scanned} failed tasks ({counts or 'none'})")
+
 
 if __name__ == '__main__':
     main()
@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python authors.py $1 $2
\ No newline at end of file
+python authors.py "$@"
\ No newline at end of file
@@ -0,0 +1,3 @@
+#!/bin/bash
+source venv/bin/activate
+python build_image_index.py "$@"
\ No newline at end of file
@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python clean_to_webdav.py
\ No newline at end of file
+exec python clean_to_webdav.py "$@"
\ No newline at end of file
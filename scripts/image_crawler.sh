@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python image_crawler.py
\ No newline at end of file
+exec python image_crawler.py "$@"
\ No newline at end of file
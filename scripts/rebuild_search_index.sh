@@ -0,0 +1,3 @@
+#!/bin/bash
+source venv/bin/activate
+python rebuild_search_index.py "$@"
\ No newline at end of file
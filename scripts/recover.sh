@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python recover.py
\ No newline at end of file
+python recover.py "$@"
\ No newline at end of file
@@ -0,0 +1,3 @@
+#!/bin/bash
+source venv/bin/activate
+python rekey.py "$@"
\ No newline at end of file
@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python restart_failed_tasks.py
\ No newline at end of file
+python restart_failed_tasks.py "$@"
@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python telegram_poster.py
\ No newline at end of file
+exec python telegram_poster.py "$@"
\ No newline at end of file
@@ -1,3 +1,3 @@
 #!/bin/bash
 source venv/bin/activate
-python twitter_crawler.py
\ No newline at end of file
+python twitter_crawler.py "$@"
\ No newline at end of file
@@ -1,5 +1,7 @@
 #!/bin/bash
 cd "$(dirname $(dirname $0))"
 task=image_crawler
-time_limit=5m
-timeout $time_limit /usr/local/bin/docker-compose run --rm $task >> log/$task.out.log 2>> log/$task.err.log
\ No newline at end of file
+time_limit=300
+# The run stops taking items at its deadline; the rest of the limit covers container start and stop.
+deadline=$(( $(date +%s) + time_limit - 15 ))
+timeout $time_limit /usr/local/bin/docker-compose run --rm $task ./scripts/$task.sh --deadline $deadline >> log/$task.out.log 2>> log/$task.err.log
\ No newline at end of file
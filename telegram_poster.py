@@ -1,14 +1,17 @@
+import argparse
 import traceback
 from itertools import chain
-from typing import List, TypeVar, Iterable
+from typing import List, TypeVar, Iterable, Optional
 
 from telegram import InputMediaPhoto, Bot
 from telegram.ext import Updater
 
-from lib.cache import read_cache
-from lib.config import parse, TelegramConfig
+from lib.cache import read_upload
+from lib.config import parse, TelegramConfig, UConfig
 from lib.db import UDB
-from lib.utils import TargetType
+from lib.profiling import add_profile_argument, profile_run, timed
+from lib.utils import TargetType, MessageStatus
+from lib.worker import Deadline, add_deadline_argument, poll_within, run_stage
 
 T = TypeVar("T")
 
@@ -27,36 +30,57 @@ def get_updater(config: TelegramConfig) -> Updater:
     return Updater(config.token, use_context=False)
 
 
+def post_messages(db: UDB, updater: Updater, config: UConfig, limit: Optional[int], deadline: Deadline) -> int:
+    n = 0
+    for post in poll_within(db, MessageStatus.Posting, limit, deadline):
+        n += 1
+        try:
+            images: 'chain[str]' = post.media_list
+            for urls in chunk(images, config.telegram.media_group_limit):
+                files = map(db.get_file, urls)
+                media = [
+                    InputMediaPhoto(read_upload(f))
+                    for f in files
+                ]
+                for ch in config.telegram.channels:
+                    with timed('telegram'):
+                        res = updater.bot.send_media_group(f"@{ch}", media=media)
+                    for r in res:
+                        message_id = r['message_id']
+                        db.reversed_index_add(TargetType.Telegram, f'{ch}/{message_id}', post.uid)
+                if config.telegram.private_channels:
+                    for ch in config.telegram.private_channels:
+                        with timed('telegram'):
+                            updater.bot.send_media_group(ch, media=media)
+        except Exception as err:
+            traceback.print_exc()
+            db.retry_or_fail(post.uid, db.post_retry, config.crawler.retry_limit, err)
+        else:
+            print("DONE:", post.uid)
+            db.add_success(post.uid)
+    return n
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--follow', action='store_true', help='keep running and wake up on new posts')
+    add_deadline_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
     with open('config.toml') as cf:
         config = parse(cf)
     updater = get_updater(config.telegram)
-    with UDB(config.redis) as db:
-        posts = list(db.post_iter_poll(config.crawler.post_limit))
-        for post in posts:
-            try:
-                images: 'chain[str]' = post.media_list
-                for urls in chunk(images, config.telegram.media_group_limit):
-                    files = map(db.get_file, urls)
-                    media = [
-                        InputMediaPhoto(read_cache(f))
-                        for f in files
-                    ]
-                    for ch in config.telegram.channels:
-                        res = updater.bot.send_media_group(f"@{ch}", media=media)
-                        for r in res:
-                            message_id = r['message_id']
-                            db.reversed_index_add(TargetType.Telegram, f'{ch}/{message_id}', post.uid)
-                    if config.telegram.private_channels:
-                        for ch in config.telegram.private_channels:
-                            updater.bot.send_media_group(ch, media=media)
-            except Exception as err:
-                traceback.print_exc()
-                db.retry_or_fail(post.uid, db.post_retry, config.crawler.retry_limit)
-            else:
-                print("DONE:", post.uid)
-                db.add_success(post.uid)
-
+    with profile_run('telegram_poster', args.profile), UDB(config.redis, crawler=config.crawler) as db:
+        deadline = Deadline(db, MessageStatus.Posting, args.deadline)
+        if args.follow:
+            # post_limit bounds how many posted messages may wait for the WebDAV cleaner
+            step = lambda: post_messages(db, updater, config, max(config.crawler.post_limit - db.success_count(), 0),
+                                         deadline)
+        elif args.deadline is not None:
+            step = lambda: post_messages(db, updater, config, None, deadline)
+        else:
+            step = lambda: post_messages(db, updater, config, config.crawler.post_limit, deadline)
+        run_stage(db, MessageStatus.Posting, step, args.follow, downstream=MessageStatus.Cleaned, deadline=deadline)
 
 
 if __name__ == '__main__':
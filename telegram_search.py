@@ -1,33 +1,92 @@
+import re
 from functools import partial
+from io import BytesIO
+
+from PIL import Image
 
 from telegram import Update, Message
 from telegram.ext import Updater, Dispatcher, MessageHandler, Filters, CommandHandler, CallbackContext
 
 from lib.config import parse, TelegramConfig
 from lib.db import UDB
-from lib.utils import TargetType
+from lib.image_index import ImageIndex, update_index
+from lib.phash import image_hash
+from lib.utils import TargetType, UMessage
+
+SEARCH_PAGE_SIZE = 5
+IMAGE_MAX_DISTANCE = 10
+IMAGE_INDEX_INTERVAL = 3600
 
 
 def handle_start(update: Update, context: CallbackContext):
     message: Message = update.message
     message.reply_text("""你好！欢迎使用本bot
 直接转发消息可以搜索图片来源，只能搜索本bot发送的图片，太旧的图片可能也会搜不出来，还请谅解
+直接发送图片也可以搜索，压缩过或者只裁掉一小部分的图片一般也能找到
+/search 关键词 @作者 可以按正文和作者搜索，末尾加 p:2 翻页
 回复/help 可以再看一次! """)
 
 
-def handle_forward(db: UDB, update: Update, context: CallbackContext):
+def handle_forward(db: UDB, index: ImageIndex, update: Update, context: CallbackContext):
     message: Message = update.message
     print(message)
-    chat_name = message.forward_from_chat.username
-    message_id = message.forward_from_message_id
-    tid = f'{chat_name}/{message_id}'
-    result = db.reversed_index_get(TargetType.Telegram, tid)
+    result = None
+    if message.forward_from_chat is not None:
+        tid = f'{message.forward_from_chat.username}/{message.forward_from_message_id}'
+        result = db.reversed_index_get(TargetType.Telegram, tid)
+    if result is None and message.photo:
+        return handle_photo(db, index, update, context)
     if result is None:
         reply = "抱歉，我不记得我发过这张图了"
     else:
-        reply = f"由 {result.type.name} 的 {result.author} 创作:\n" + \
-                f"正文: {result.content}\n" + \
-                f"来源: {result.source}"
+        reply = _format_result(result)
+    message.reply_text(reply)
+
+
+def handle_photo(db: UDB, index: ImageIndex, update: Update, context: CallbackContext):
+    message: Message = update.message
+    bio = BytesIO()
+    message.photo[-1].get_file().download(out=bio)
+    bio.seek(0)
+    h = image_hash(Image.open(bio))
+    # Hashes logged since the last index build are scanned from Redis so new posts are found right away.
+    index.refresh()
+    tail = db.image_hash_range(len(index))
+    matches = index.search(h, tail, IMAGE_MAX_DISTANCE, SEARCH_PAGE_SIZE)
+    results = [m for m in db.get_data_many(uid for _, uid in matches) if m is not None]
+    if not results:
+        message.reply_text("抱歉，没有找到相似的图片")
+        return
+    message.reply_text("\n\n".join(_format_result(r) for r in results))
+
+
+def refresh_image_index(db: UDB, index: ImageIndex, context: CallbackContext):
+    update_index(db)
+    index.refresh()
+
+
+def _format_result(result: UMessage) -> str:
+    return f"由 {result.type.name} 的 {result.author} 创作:\n" + \
+           f"正文: {result.content}\n" + \
+           f"来源: {result.source}"
+
+
+def handle_search(db: UDB, update: Update, context: CallbackContext):
+    message: Message = update.message
+    args = list(context.args or [])
+    page = 1
+    if args and re.match(r'^p:\d+$', args[-1]):
+        page = max(int(args.pop()[2:]), 1)
+    query = ' '.join(args)
+    if not query:
+        message.reply_text("用法: /search 关键词 @作者 [p:页码]")
+        return
+    total, results = db.search(query, (page - 1) * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+    if not results:
+        message.reply_text("抱歉，没有找到相关的图片")
+        return
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    reply = "\n\n".join(_format_result(r) for r in results) + f"\n\n第 {page}/{pages} 页，共 {total} 条"
     message.reply_text(reply)
 
 
@@ -43,7 +102,12 @@ def main():
         dp: Dispatcher = updater.dispatcher
         dp.add_handler(CommandHandler("start", handle_start))
         dp.add_handler(CommandHandler("help", handle_start))
-        dp.add_handler(MessageHandler(Filters.forwarded, partial(handle_forward, db)))
+        dp.add_handler(CommandHandler("search", partial(handle_search, db)))
+        update_index(db)
+        index = ImageIndex()
+        updater.job_queue.run_repeating(partial(refresh_image_index, db, index), IMAGE_INDEX_INTERVAL)
+        dp.add_handler(MessageHandler(Filters.forwarded, partial(handle_forward, db, index)))
+        dp.add_handler(MessageHandler(Filters.photo, partial(handle_photo, db, index)))
         updater.start_polling()
         print("Bot Started")
         updater.idle()
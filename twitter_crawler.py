@@ -1,13 +1,31 @@
+import argparse
+import json
 import sys
+import threading
+import time
 from collections import deque
 import re
-from typing import Iterable, NamedTuple, List, Optional, Set, Tuple, Deque
+from typing import Iterable, NamedTuple, List, Optional, Set, Tuple, Deque, Dict, Iterator
 
+import requests
 import tweepy
 from lib.config import TwitterConfig, parse
 from lib.db import UDB
+from lib.db.retry import RetryBackoff
+from lib.profiling import add_profile_argument, profile_run, timed
+from lib.source import Source, ingest
 from lib.utils import UMessage, MessageType
 
+STREAM_STALL_TIMEOUT = 90
+MONITOR_REFRESH_INTERVAL = 300
+LOOKUP_BATCH = 100
+
+# Reconnect schedule recommended for the streaming API: quick retries on network errors,
+# longer ones on HTTP errors and a minute or more when rate limited.
+_NETWORK_BACKOFF = RetryBackoff(0.25, 16)
+_HTTP_BACKOFF = RetryBackoff(5, 320)
+_RATE_LIMIT_BACKOFF = RetryBackoff(60, 960)
+
 
 class RelatedStatusRef(NamedTuple):
     username: str
@@ -82,49 +100,231 @@ def _walk_status(api: tweepy.API, status: tweepy.models.Status, max_depth: int)
             for r in msg.related_id:
                 if r is None:
                     continue
-                rs = api.get_status(r.id)
+                try:
+                    with timed('twitter'):
+                        rs = api.get_status(r.id)
+                except tweepy.error.RateLimitError:
+                    raise
+                except tweepy.error.TweepError as err:
+                    # Deleted or protected statuses are skipped, not worth dropping the rest for.
+                    print(f"Skip status {r.id}: ", err)
+                    continue
                 q.append((rs, depth + 1))
 
 
-def get_twitter_medias(api: tweepy.API, db: UDB, username: str) -> Iterable[UMessage]:
-    tl = api.user_timeline(username)
-    for status in tl:
-        uid = f"{MessageType.Twitter.value}_{status.id}"
-        if db.data_exists(uid):
+def _timeline(api: tweepy.API, username: str, since_id: Optional[int] = None) -> List[tweepy.models.Status]:
+    with timed('twitter'):
+        return api.user_timeline(username, since_id=since_id, count=200 if since_id else None)
+
+
+def get_twitter_medias(api: tweepy.API, db: UDB, username: str, since_id: Optional[int] = None) -> Iterable[UMessage]:
+    yield from _timeline_medias(api, db, _timeline(api, username, since_id))
+
+
+def _timeline_medias(api: tweepy.API, db: UDB, tl: List[tweepy.models.Status]) -> Iterable[UMessage]:
+    seen = db.data_exists_many(f"{MessageType.Twitter.value}_{status.id}" for status in tl)
+    for status, s in zip(tl, seen):
+        if s:
             continue
         yield from _walk_status(api, status, 2)
 
 
-def _safe_get_twitter_medias(api: tweepy.API, db: UDB, username: str) -> Iterable[UMessage]:
+def _media_messages(db: UDB, monitors: Set[str], mu: str, msgs: Iterable[UMessage]) -> Iterator[UMessage]:
+    # Statuses by other users and retweets only feed the relation counts, which skip status ids
+    # they have already counted.
+    for msg in msgs:
+        if msg.author not in monitors:
+            r = db.relation_add(MessageType.Twitter, mu, msg.author, msg.id)
+            print(f"Rel Add: {mu} => {msg.author} [{r}]")
+            continue
+        retweet_user = _get_retweet_name(msg.content)
+        if retweet_user is not None:
+            r = db.relation_add(MessageType.Twitter, msg.author, retweet_user, msg.id)
+            print(f"Rel Add: {msg.author} => {retweet_user} [{r}]")
+            continue
+        if not msg.media_list:
+            continue
+        yield msg
+
+
+class TwitterSource(Source):
+    type = MessageType.Twitter
+
+    def __init__(self, api: tweepy.API, monitors: Set[str], since_id: Optional[int] = None,
+                 fresh: Set[str] = frozenset()):
+        self.api = api
+        self.monitors = monitors
+        self.since_id = since_id
+        self.fresh = fresh
+        self.max_id: Optional[int] = None
+        self.rate_limited = False
+
+    def produce(self, db: UDB) -> Iterator[UMessage]:
+        # Monitors in fresh have no stream history yet and get their latest timeline instead of a gap fill.
+        for mu in self.monitors:
+            since_id = None if mu in self.fresh else self.since_id
+            try:
+                tl = _timeline(self.api, mu, since_id)
+                if tl:
+                    self.max_id = max(self.max_id or 0, max(s.id for s in tl))
+                yield from _media_messages(db, self.monitors, mu, _timeline_medias(self.api, db, tl))
+            except tweepy.error.TweepError as err:
+                self.rate_limited |= isinstance(err, tweepy.error.RateLimitError)
+                print(f"Error on Twitter @ {mu}: ", err)
+
+
+def poll(api: tweepy.API, db: UDB, monitors: Set[str], since_id: Optional[int] = None,
+         fresh: Set[str] = frozenset()) -> TwitterSource:
+    source = TwitterSource(api, monitors, since_id, fresh)
+    ingest(db, source.produce(db))
+    return source
+
+
+def _lookup_user_ids(api: tweepy.API, names: Iterable[str]) -> Dict[str, str]:
+    names = list(names)
+    ids = {}
+    for i in range(0, len(names), LOOKUP_BATCH):
+        with timed('twitter'):
+            users = api.lookup_users(screen_names=names[i:i + LOOKUP_BATCH])
+        for u in users:
+            ids[u.id_str] = u.screen_name
+    return ids
+
+
+def _stream_lines(config: TwitterConfig, auth: tweepy.OAuthHandler, user_ids: Iterable[str]) -> Iterator[bytes]:
+    # Twitter sends a blank keep-alive line every 30s, so a read timeout means the connection stalled.
+    with requests.post(config.stream_url, data={'follow': ','.join(user_ids), 'stall_warnings': 'true'},
+                       auth=auth.apply_auth(), stream=True, timeout=(10, STREAM_STALL_TIMEOUT)) as res:
+        res.raise_for_status()
+        yield from res.iter_lines()
+
+
+class _SinceId:
+    """
+    Newest status id seen by the stream and the gap fills. It is only saved while no gap fill is
+    outstanding, so a restart polls again from before any gap that was not filled.
+    """
+
+    def __init__(self, db: UDB):
+        self.db = db
+        self.saved = db.since_id_get(MessageType.Twitter)
+        self.value = self.saved
+        self.filling = False
+        self._lock = threading.Lock()
+
+    def _save(self):
+        if self.value is not None and self.value != self.saved:
+            self.db.since_id_set(MessageType.Twitter, self.value)
+            self.saved = self.value
+
+    def advance(self, id_: Optional[int]):
+        with self._lock:
+            if id_ is not None and (self.value is None or id_ > self.value):
+                self.value = id_
+            if not self.filling:
+                self._save()
+
+    def fill_started(self):
+        with self._lock:
+            self.filling = True
+
+    def fill_done(self, max_id: Optional[int]):
+        with self._lock:
+            self.filling = False
+        self.advance(max_id)
+
+
+def _fill_gap(api: tweepy.API, db: UDB, monitors: Set[str], since: _SinceId, gap_since: Optional[int],
+              fresh: Set[str]):
     try:
-        yield from get_twitter_medias(api, db, username)
-    except tweepy.error.TweepError as err:
-        print(f"Error on Twitter @ {username}: ", err)
+        source = poll(api, db, monitors, gap_since, fresh)
+    except Exception as err:
+        print("Gap fill failed: ", err, file=sys.stderr)
+        return
+    if source.rate_limited:
+        print("Gap fill rate limited, retrying on the next connection", file=sys.stderr)
+        return
+    since.fill_done(source.max_id)
+
+
+def _tweep_backoff(err: tweepy.error.TweepError) -> RetryBackoff:
+    return _RATE_LIMIT_BACKOFF if isinstance(err, tweepy.error.RateLimitError) else _HTTP_BACKOFF
+
+
+def stream(api: tweepy.API, db: UDB, config: TwitterConfig):
+    since = _SinceId(db)
+    monitors: Optional[Set[str]] = None
+    fresh: Set[str] = set()
+    gap: Optional[threading.Thread] = None
+    attempt = 0
+    while True:
+        if gap is not None:
+            gap.join()
+        current = set(db.monitor_list(MessageType.Twitter))
+        # Monitors added since the last gap fill that completed still need their first timeline.
+        fresh = (fresh if since.filling else set()) | (current - monitors if monitors is not None else set())
+        monitors = current
+        since.fill_started()
+        gap_since = since.saved
+        gap = None
+        changed = False
+        try:
+            user_ids = _lookup_user_ids(api, monitors)
+            refresh_at = time.time() + MONITOR_REFRESH_INTERVAL
+            for line in _stream_lines(config, api.auth, user_ids):
+                attempt = 0
+                if gap is None:
+                    # Catch up on whatever was posted while disconnected once the stream is live, so
+                    # nothing falls between the timeline poll and the connection. The poll runs beside
+                    # the reader so the connection keeps being drained.
+                    gap = threading.Thread(target=_fill_gap, args=(api, db, monitors, since, gap_since, fresh),
+                                           daemon=True)
+                    gap.start()
+                if time.time() > refresh_at:
+                    refresh_at = time.time() + MONITOR_REFRESH_INTERVAL
+                    if set(db.monitor_list(MessageType.Twitter)) != monitors:
+                        changed = True
+                        break
+                if not line:
+                    continue
+                data = json.loads(line)
+                if 'id' not in data:
+                    print("Stream notice:", data)
+                    continue
+                if data['user']['id_str'] not in user_ids:
+                    continue
+                status = tweepy.models.Status.parse(api, data)
+                ingest(db, _media_messages(db, monitors, status.author.screen_name, _walk_status(api, status, 2)))
+                since.advance(status.id)
+            err, delay = "stream closed", _NETWORK_BACKOFF.delay(attempt)
+        except requests.HTTPError as e:
+            code = e.response.status_code
+            err, delay = e, (_RATE_LIMIT_BACKOFF if code in (420, 429) else _HTTP_BACKOFF).delay(attempt)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            err, delay = e, _NETWORK_BACKOFF.delay(attempt)
+        except tweepy.error.TweepError as e:
+            err, delay = e, _tweep_backoff(e).delay(attempt)
+        if changed:
+            print("Monitors changed, reconnecting")
+            continue
+        attempt += 1
+        print(f"Stream disconnected ({err}), reconnecting in {delay:.1f}s", file=sys.stderr)
+        time.sleep(delay)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream', action='store_true', help='follow monitors over the streaming API instead of polling once')
+    add_profile_argument(parser)
+    args = parser.parse_args()
     with open('config.toml') as cf:
         config = parse(cf)
     api = start_authorization(config.twitter)
-    with UDB(config.redis) as db:
-        monitors = set(db.monitor_list(MessageType.Twitter))
-        for mu in monitors:
-            for msg in _safe_get_twitter_medias(api, db, mu):
-                if db.data_exists(msg.uid):
-                    continue
-                if msg.author not in monitors:
-                    r = db.relation_add(MessageType.Twitter, mu, msg.author, msg.id)
-                    print(f"Rel Add: {mu} => {msg.author} [{r}]")
-                    continue
-                retweet_user = _get_retweet_name(msg.content)
-                if retweet_user is not None:
-                    r = db.relation_add(MessageType.Twitter, msg.author, retweet_user, msg.id)
-                    print(f"Rel Add: {msg.author} => {retweet_user} [{r}]")
-                    continue
-                if not msg.media_list:
-                    continue
-                db.download_add(msg)
-                print(msg)
+    with profile_run('twitter_crawler', args.profile), UDB(config.redis) as db:
+        if args.stream:
+            stream(api, db, config.twitter)
+        else:
+            poll(api, db, set(db.monitor_list(MessageType.Twitter)))
 
 
 if __name__ == '__main__':